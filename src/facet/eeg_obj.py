@@ -1,11 +1,416 @@
+import bisect
+import mmap
+import os
+import tempfile
 import numpy as np
 from copy import deepcopy
 
 
+def zeros(shape, dtype=np.float64, memmap_dir=None):
+    """
+    Returns an array of zeros, in a temporary file in memmap_dir if it is set.
+
+    The file has no name and is removed by the operating system when the array is
+    released.
+
+    Parameters:
+        shape (tuple): The shape of the array.
+        dtype (numpy.dtype, optional): The dtype of the array.
+        memmap_dir (str, optional): The directory of the file, None keeps the array in memory.
+
+    Returns:
+        numpy.ndarray: The array, a numpy.memmap if memmap_dir is set.
+    """
+    if memmap_dir is None or np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(
+        tempfile.TemporaryFile(dir=memmap_dir), dtype=dtype, mode="w+", shape=shape
+    )
+
+
+def store(array, dtype=np.float64, memmap_dir=None):
+    """
+    Converts an array to a dtype and moves it into a temporary file in memmap_dir if it is set.
+
+    Parameters:
+        array (numpy.ndarray): The array.
+        dtype (numpy.dtype, optional): The dtype of the stored array.
+        memmap_dir (str, optional): The directory of the file, None keeps the array in memory.
+
+    Returns:
+        numpy.ndarray: A memory-mapped copy of the array, or the array itself if it is
+        neither memory-mapped nor converted.
+    """
+    if memmap_dir is None:
+        return array.astype(dtype, copy=False)
+    stored = zeros(array.shape, dtype, memmap_dir)
+    # row by row, so no second copy of the array is made in memory
+    for i in range(array.shape[0]):
+        stored[i] = array[i]
+    return stored
+
+
+def copy_on_write(array, memmap_dir):
+    """
+    Returns two copy-on-write copies of an array that share its memory until they are written.
+
+    The array is written once into a temporary file, which is never changed
+    afterwards, and both copies map the file privately. A memory-mapped array is
+    written into a file in memmap_dir, an array in memory into a file in memory. Pages
+    that are only read stay shared between the copies, a page that is written is
+    duplicated in the memory of the copy that writes it. As the arrays are stored row
+    by row, changing one channel only duplicates this channel.
+
+    Parameters:
+        array (numpy.ndarray): The array.
+        memmap_dir (str): The directory of the file of a memory-mapped array.
+
+    Returns:
+        tuple: Two copies of the array, numpy.memmap copies if the array is memory-mapped.
+    """
+    if array.size == 0:
+        return array.copy(), array.copy()
+    if not isinstance(array, np.memmap):
+        with open(os.memfd_create("facet"), "w+b") as file:
+            array.tofile(file)
+            file.flush()
+            return tuple(
+                np.frombuffer(
+                    mmap.mmap(file.fileno(), array.nbytes, access=mmap.ACCESS_COPY),
+                    dtype=array.dtype,
+                ).reshape(array.shape)
+                for _ in range(2)
+            )
+    file = tempfile.TemporaryFile(dir=memmap_dir)
+    shared = np.memmap(file, dtype=array.dtype, mode="w+", shape=array.shape)
+    shared[...] = array
+    shared.flush()
+    del shared
+    return tuple(
+        np.memmap(file, dtype=array.dtype, mode="c", shape=array.shape)
+        for _ in range(2)
+    )
+
+
+def shares_on_write(array, memmap_dir):
+    """
+    Returns whether copies of an array are shared with copy_on_write instead of copied.
+
+    Memory-mapped arrays are shared through a file in memmap_dir, so that copying them
+    does not pull them into memory. Arrays in memory are shared through a file in
+    memory, where the system supports one.
+
+    Parameters:
+        array (numpy.ndarray): The array.
+        memmap_dir (str): The directory of memory-mapped arrays, or None.
+
+    Returns:
+        bool: Whether the array is shared.
+    """
+    if isinstance(array, np.memmap):
+        return memmap_dir is not None
+    return hasattr(os, "memfd_create")
+
+
+class CompactNoise:
+    """
+    The estimated noise, stored only for the channels and the artifact windows it was written to.
+
+    The noise is zero outside the artifact windows of the corrected channels, so it is
+    kept as a sorted list of disjoint windows, each a (channels x span) block of these
+    channels. Windows that touch or overlap are joined into one. Writing next to a
+    window grows it, at least to twice its length, so growing it step by step stays
+    cheap. Dense arrays are only built when they are asked for, with rows, toarray or
+    numpy.asarray, and only for the samples asked for.
+
+    With memmap_dir, all windows are mapped from one temporary file, so that many
+    windows do not need many open files. The space of a window that is joined into
+    another is only freed with the file, when the noise is released.
+
+    Attributes:
+        shape (tuple): The (channels x samples) shape of the dense noise.
+        dtype (numpy.dtype): The precision of the noise.
+        channels (list): The channels that are stored, in the order of the window rows.
+        starts (list): The first sample of every window, in increasing order.
+        blocks (list): The stored noise of every window, (channels x span).
+    """
+
+    def __init__(self, shape, dtype=np.float64, memmap_dir=None):
+        """
+        Initializes an all-zero noise.
+
+        Parameters:
+            shape (tuple): The (channels x samples) shape of the dense noise.
+            dtype (numpy.dtype, optional): The precision of the noise.
+            memmap_dir (str, optional): Directory of the memory-mapped windows, None keeps them in memory.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.memmap_dir = memmap_dir
+        self.channels = []
+        self.starts = []
+        self.blocks = []
+        self._file = None
+        self._file_size = 0
+
+    @classmethod
+    def from_dense(cls, array, dtype=None, memmap_dir=None):
+        """
+        Stores the channels and the runs of samples of a dense noise array that are not zero.
+
+        Parameters:
+            array (numpy.ndarray): The (channels x samples) noise.
+            dtype (numpy.dtype, optional): The precision of the noise. Defaults to the dtype of the array.
+            memmap_dir (str, optional): Directory of the memory-mapped windows, None keeps them in memory.
+
+        Returns:
+            CompactNoise: The noise.
+        """
+        noise = cls(array.shape, array.dtype if dtype is None else dtype, memmap_dir)
+        channels = [int(ch) for ch in np.flatnonzero(np.any(array, axis=1))]
+        if channels:
+            columns = np.flatnonzero(np.any(array[channels], axis=0))
+            breaks = np.flatnonzero(np.diff(columns) > 1)
+            for first, last in zip(
+                columns[np.r_[0, breaks + 1]], columns[np.r_[breaks, -1]]
+            ):
+                noise.add_block(channels, first, array[channels, first : last + 1])
+        return noise
+
+    def _allocate(self, shape):
+        """
+        Returns a new all-zero block, at the end of the file of the noise if it is memory-mapped.
+
+        Parameters:
+            shape (tuple): The (channels x span) shape of the block.
+
+        Returns:
+            numpy.ndarray: The block.
+        """
+        if self.memmap_dir is None or np.prod(shape) == 0:
+            return np.zeros(shape, dtype=self.dtype)
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.memmap_dir)
+            self._file_size = 0
+        # r+ extends the file with zeros to the end of the block
+        block = np.memmap(
+            self._file, dtype=self.dtype, mode="r+", offset=self._file_size, shape=shape
+        )
+        self._file_size += block.nbytes
+        return block
+
+    def _stop(self, i):
+        return self.starts[i] + self.blocks[i].shape[1]
+
+    def any(self):
+        """
+        Returns whether the noise is not zero anywhere.
+        """
+        return any(np.any(block) for block in self.blocks)
+
+    def reserve(self, channels, start, stop, grow=True):
+        """
+        Makes room for the channels between start and stop, joining the windows it touches.
+
+        Not thread-safe, the windows must be reserved before threads write to them.
+
+        Parameters:
+            channels (list): The channels that are written to.
+            start (int): The first sample that is written to.
+            stop (int): The end of the samples that are written to.
+            grow (bool, optional): Whether a window that is extended grows to at least
+            twice its length. Defaults to True.
+        """
+        new_channels = [int(ch) for ch in channels if int(ch) not in self.channels]
+        if new_channels:
+            for i, block in enumerate(self.blocks):
+                grown = self._allocate(
+                    (len(self.channels) + len(new_channels), block.shape[1])
+                )
+                grown[: len(self.channels)] = block
+                self.blocks[i] = grown
+            self.channels = self.channels + new_channels
+        start, stop = max(int(start), 0), min(int(stop), self.shape[1])
+        if start >= stop:
+            return
+        # the windows that overlap or touch the samples
+        first = bisect.bisect_left(
+            [self._stop(i) for i in range(len(self.blocks))], start
+        )
+        last = bisect.bisect_right(self.starts, stop)
+        if (
+            last - first == 1
+            and self.starts[first] <= start
+            and stop <= self._stop(first)
+        ):
+            return
+        new_start, new_stop = start, stop
+        if last > first:
+            old_start, old_stop = self.starts[first], self._stop(last - 1)
+            length = old_stop - old_start
+            new_start, new_stop = min(start, old_start), max(stop, old_stop)
+            if grow and new_start < old_start:
+                low = self._stop(first - 1) if first > 0 else 0
+                new_start = max(min(new_start, old_stop - 2 * length), low)
+            if grow and new_stop > old_stop:
+                high = self.starts[last] if last < len(self.starts) else self.shape[1]
+                new_stop = min(max(new_stop, old_start + 2 * length), high)
+        block = self._allocate((len(self.channels), new_stop - new_start))
+        for i in range(first, last):
+            offset = self.starts[i] - new_start
+            block[:, offset : offset + self.blocks[i].shape[1]] = self.blocks[i]
+        self.starts[first:last] = [new_start]
+        self.blocks[first:last] = [block]
+
+    def add(self, ch_id, positions, values, overlapping):
+        """
+        Adds values at sample positions of a reserved channel.
+
+        Parameters:
+            ch_id (int): The index of the channel.
+            positions (numpy.ndarray): The sample position of every value.
+            values (numpy.ndarray): The values, flattened like positions.
+            overlapping (bool): Whether positions contains samples more than once.
+        """
+        if len(positions) == 0:
+            return
+        row = self.channels.index(ch_id)
+        windows = np.searchsorted(self.starts, positions, side="right") - 1
+        if windows[0] == windows[-1] and np.all(windows == windows[0]):
+            groups = [slice(None)]
+        elif np.all(np.diff(windows) >= 0):
+            bounds = np.r_[0, np.flatnonzero(np.diff(windows)) + 1, len(windows)]
+            groups = [slice(low, high) for low, high in zip(bounds[:-1], bounds[1:])]
+        else:
+            order = np.argsort(windows, kind="stable")
+            groups = np.split(order, np.flatnonzero(np.diff(windows[order])) + 1)
+        for group in groups:
+            i = windows[group][0]
+            block_row = self.blocks[i][row]
+            if overlapping:
+                # applies the values one after another in their order
+                np.add.at(block_row, positions[group] - self.starts[i], values[group])
+            else:
+                block_row[positions[group] - self.starts[i]] += values[group]
+
+    def add_block(self, channels, start, block):
+        """
+        Adds a block of channels to the noise, clipped to the samples of the noise.
+
+        Parameters:
+            channels (list): The channels of the block rows.
+            start (int): The first sample of the block, may be negative.
+            block (numpy.ndarray): The noise, (channels x span).
+        """
+        first = max(-int(start), 0)
+        start, stop = int(start) + first, min(
+            int(start) + block.shape[1], self.shape[1]
+        )
+        if start >= stop:
+            return
+        self.reserve(channels, start, stop, grow=False)
+        i = bisect.bisect_right(self.starts, start) - 1
+        rows = [self.channels.index(int(ch)) for ch in channels]
+        self.blocks[i][rows, start - self.starts[i] : stop - self.starts[i]] += block[
+            :, first : first + stop - start
+        ]
+
+    def spans(self, margin=0):
+        """
+        Returns the windows with margin samples added on both sides, joined where they overlap.
+
+        Parameters:
+            margin (int, optional): The number of samples to add on both sides. Defaults to 0.
+
+        Returns:
+            list: Tuples of the first sample and the end of every span, within the samples of the noise.
+        """
+        spans = []
+        for i, start in enumerate(self.starts):
+            start = max(start - margin, 0)
+            stop = min(self._stop(i) + margin, self.shape[1])
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], stop)
+            else:
+                spans.append((start, stop))
+        return spans
+
+    def rows(self, channels, start=0, stop=None):
+        """
+        Returns the dense noise of channels between two samples.
+
+        Parameters:
+            channels (list): The channels.
+            start (int, optional): The first sample, may be negative. Defaults to 0.
+            stop (int, optional): The end of the samples, may be beyond the end of the noise.
+            Defaults to the end of the noise.
+
+        Returns:
+            numpy.ndarray: The noise, (channels x samples).
+        """
+        stop = self.shape[1] if stop is None else stop
+        dense = np.zeros((len(channels), stop - start), dtype=self.dtype)
+        keys = [key for key, ch_id in enumerate(channels) if ch_id in self.channels]
+        rows = [self.channels.index(channels[key]) for key in keys]
+        for i in range(bisect.bisect_right(self.starts, start) - 1, len(self.starts)):
+            if i < 0:
+                continue
+            low, high = max(start, self.starts[i]), min(stop, self._stop(i))
+            if self.starts[i] >= stop:
+                break
+            if low < high:
+                dense[keys, low - start : high - start] = self.blocks[i][
+                    rows, low - self.starts[i] : high - self.starts[i]
+                ]
+        return dense
+
+    def toarray(self):
+        """
+        Returns the dense noise of all channels.
+        """
+        return self.rows(range(self.shape[0]))
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.toarray()
+        return dense if dtype is None else dense.astype(dtype, copy=False)
+
+    def copy(self):
+        """
+        Returns a copy of the noise.
+
+        Memory-mapped windows are shared copy-on-write with the copy: from now on both
+        map the file privately, so a page that is written is duplicated in the memory of
+        the noise that writes it. New windows of the copy go into a file of its own.
+        """
+        copied = CompactNoise(self.shape, self.dtype, self.memmap_dir)
+        copied.channels = list(self.channels)
+        copied.starts = list(self.starts)
+        if self._file is None:
+            copied.blocks = [block.copy() for block in self.blocks]
+            return copied
+
+        def private(block):
+            if not isinstance(block, np.memmap):
+                return block.copy()
+            return np.memmap(
+                self._file,
+                dtype=self.dtype,
+                mode="c",
+                offset=block.offset,
+                shape=block.shape,
+            )
+
+        copied.blocks = [private(block) for block in self.blocks]
+        self.blocks = [private(block) for block in self.blocks]
+        return copied
+
+
 class EEG:
     mne_raw: None  # The MNE raw object storing the EEG data
     mne_raw_orig: None  # Untouched MNE raw object storing the EEG data
-    estimated_noise = None  # The estimated noise of the EEG data used for the ANC
+    estimated_noise = (
+        None  # The estimated noise of the EEG data used for the ANC, a CompactNoise
+    )
     _tmin = None
     _tmax = None
     artifact_to_trigger_offset: None
@@ -21,6 +426,9 @@ class EEG:
     artifact_duration = None
     volume_gaps = None
     BIDSPath = None
+    memmap_dir = None  # Directory of memory-mapped arrays, None keeps them in RAM
+    memmap_noise = False  # Whether the estimated noise is memory-mapped as well
+    dtype = np.dtype(np.float64)  # The precision of the data and the estimated noise
 
     # calculations
     anc_hp_frequency = None  # The highpass frequency of the ANC
@@ -47,6 +455,9 @@ class EEG:
         artifact_duration=0,
         volume_gaps=None,
         BIDSPath=None,
+        memmap_dir=None,
+        memmap_noise=False,
+        dtype=np.float64,
     ):
         self.mne_raw = mne_raw
         self.mne_raw_orig = (
@@ -69,6 +480,9 @@ class EEG:
         self.artifact_duration = artifact_duration
         self.volume_gaps = volume_gaps
         self.BIDSPath = BIDSPath
+        self.memmap_dir = memmap_dir
+        self.memmap_noise = memmap_noise
+        self.dtype = np.dtype(dtype)
 
         # calculations
         self._tmin = self.artifact_to_trigger_offset
@@ -97,8 +511,80 @@ class EEG:
     def get_tmax(self):
         return self._tmax
 
+    def zeros(self, shape, memmap=True):
+        """
+        Returns an array of zeros in the precision of the data, in a temporary file in memmap_dir if it is set.
+
+        The file has no name and is removed by the operating system when the array is
+        released.
+
+        Parameters:
+            shape (tuple): The shape of the array.
+            memmap (bool, optional): Whether the array may be memory-mapped. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The array, a numpy.memmap if memmap_dir is set and memmap is True.
+        """
+        return zeros(shape, self.dtype, self.memmap_dir if memmap else None)
+
+    def new_noise(self, shape):
+        """
+        Returns an empty estimated noise in the precision of the data.
+
+        Parameters:
+            shape (tuple): The (channels x samples) shape of the data.
+
+        Returns:
+            CompactNoise: The estimated noise, memory-mapped if memmap_dir and memmap_noise are set.
+        """
+        return CompactNoise(
+            shape, self.dtype, self.memmap_dir if self.memmap_noise else None
+        )
+
+    def store(self, array, memmap=True):
+        """
+        Converts an array to the precision of the data and moves it into a temporary file in memmap_dir if it is set.
+
+        Parameters:
+            array (numpy.ndarray): The array.
+            memmap (bool, optional): Whether the array may be memory-mapped. Defaults to True.
+
+        Returns:
+            numpy.ndarray: A memory-mapped copy of the array, or the array itself if it is
+            neither memory-mapped nor converted.
+        """
+        return store(array, self.dtype, self.memmap_dir if memmap else None)
+
     def copy(self):
-        copied = deepcopy(self)
-        copied.mne_raw = self.mne_raw.copy()
-        copied.mne_raw_orig = self.mne_raw_orig.copy()
-        return copied
+        """
+        Returns a snapshot of the EEG object.
+
+        The data of mne_raw is shared with copy_on_write, through a file that this
+        object maps as well, so a channel is only duplicated when one of them changes
+        it. The data of mne_raw_orig is shared as it is and made read-only, as it is
+        never changed. The estimated noise is copied and the other attributes are
+        deep-copied. Holding many snapshots, e.g. one per evaluated variant, thereby
+        costs little memory. The values of this object stay as they are.
+
+        Returns:
+            EEG: The snapshot.
+        """
+        # deepcopy takes the objects in memo instead of copying them
+        memo = {}
+        orig = self.mne_raw_orig
+        if orig is not None and orig is not self.mne_raw:
+            orig._data.flags.writeable = False
+            memo[id(orig._data)] = orig._data
+        for raw in (self.mne_raw, orig):
+            if raw is None:
+                continue
+            if raw is self.mne_raw and shares_on_write(raw._data, self.memmap_dir):
+                raw._data, copied_data = copy_on_write(raw._data, self.memmap_dir)
+                memo[id(raw._data)] = copied_data
+            # a RawArray keeps the data it was created with, which is shared
+            for value in getattr(raw, "_init_kwargs", {}).values():
+                if isinstance(value, np.ndarray) and value is not raw._data:
+                    memo[id(value)] = value
+        if isinstance(self.estimated_noise, CompactNoise):
+            memo[id(self.estimated_noise)] = self.estimated_noise.copy()
+        return deepcopy(self, memo)
@@ -7,10 +7,18 @@ from loguru import logger
 
 class facet:
 
-    def __init__(self):
+    def __init__(self, n_jobs=1):
+        """
+        Initializes the facet class.
+
+        Parameters:
+            n_jobs (int, optional): Number of threads the correction spreads its per-channel work and the
+            evaluation its datasets over. -1 uses all cores.
+        """
+        self._n_jobs = n_jobs
         self._analysis = AnalysisFramework(self)
         self._correction = None
-        self._evaluation = EvaluationFramework(self)
+        self._evaluation = EvaluationFramework(self, n_jobs=n_jobs)
         self._eeg = None
         mne.set_log_level("ERROR")
 
@@ -27,6 +35,10 @@ class facet:
         subject="subject1",
         session="session1",
         task="task1",
+        memmap_dir=None,
+        memmap_orig=True,
+        memmap_noise=True,
+        precision="float64",
     ):
         logger.info(f"Importing EEG from {path}")
         self._eeg = self._analysis.import_eeg(
@@ -38,8 +50,12 @@ class facet:
             subject=subject,
             session=session,
             task=task,
+            memmap_dir=memmap_dir,
+            memmap_orig=memmap_orig,
+            memmap_noise=memmap_noise,
+            precision=precision,
         )
-        self._correction = CorrectionFramework(self, self._eeg)
+        self._correction = CorrectionFramework(self, self._eeg, n_jobs=self._n_jobs)
         return self._eeg
 
     def export_eeg(
@@ -91,16 +107,32 @@ class facet:
     def prepare_ANC(self):
         logger.warning("This method is not necessary anymore. Skipping...")
 
-    def apply_ANC(self):
-        self._correction.apply_ANC()
+    def apply_ANC(self, method="fastranc"):
+        self._correction.apply_ANC(method=method)
 
     def align_triggers(self, ref_trigger_index):
         self._correction.align_triggers(ref_trigger_index)
 
-    def remove_artifacts(self, avg_artifact_matrix_numpy=None, plot_artifacts=False):
+    def remove_artifacts(
+        self,
+        avg_artifact_matrix_numpy=None,
+        plot_artifacts=False,
+        local_upsampling=False,
+    ):
         self._correction.remove_artifacts(
             avg_artifact_matrix_numpy=avg_artifact_matrix_numpy,
             plot_artifacts=plot_artifacts,
+            local_upsampling=local_upsampling,
+        )
+
+    def remove_artifacts_chunked(
+        self, rel_window_position=0, window_size=30, block_size=300, channels=None
+    ):
+        self._correction.remove_artifacts_chunked(
+            rel_window_position=rel_window_position,
+            window_size=window_size,
+            block_size=block_size,
+            channels=channels,
         )
 
     def pre_processing(self):  # Change to your liking
@@ -133,10 +165,12 @@ class facet:
     def upsample(self):
         self._correction.upsample()
 
-    def add_to_evaluate(self, eeg, start_time=None, end_time=None, name=None):
+    def add_to_evaluate(
+        self, eeg, start_time=None, end_time=None, name=None, copy=False
+    ):
         logger.info("Adding to evaluation...")
         self._evaluation.add_to_evaluate(
-            eeg, start_time=start_time, end_time=end_time, name=name
+            eeg, start_time=start_time, end_time=end_time, name=name, copy=copy
         )
 
     def evaluate(self, plot=True, measures=["SNR"]):
@@ -7,19 +7,50 @@ Date: 15.02.2024
 Version: 1.0
 """
 
+import os
+import contextlib
+import tempfile
+import weakref
 import numpy as np
 import mne
 import re
 from mne_bids import BIDSPath, write_raw_bids, read_raw_bids
 from scipy.stats import pearsonr
 from scipy.signal import firls
-from facet.eeg_obj import EEG
+from facet.eeg_obj import EEG, store
 import numpy as np
 from loguru import logger
 
 # import inst for mne python
 
 
+def _remove_file(path):
+    """
+    Removes a file, ignoring that it may already be gone or still be in use.
+    """
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+
+def _remove_when_unmapped(data, path):
+    """
+    Removes the file a memory-mapped array maps once the mapping is closed.
+
+    Windows does not remove a file that is still mapped, so the file is removed when the
+    mapping is released, after the last array that uses it. Arrays that are not mapped
+    from the file are not tied to it, and the file is removed at once.
+
+    Parameters:
+        data (numpy.ndarray): The array MNE read the data into.
+        path (str): The file.
+    """
+    mapping = getattr(data, "_mmap", None)
+    if mapping is None:
+        _remove_file(path)
+        return
+    weakref.finalize(mapping, _remove_file, path)
+
+
 class AnalysisFramework:
     def __init__(self, facet, eeg=None):
         """
@@ -48,6 +79,10 @@ class AnalysisFramework:
         subject="subjectid",
         session="sessionid",
         task="corrected",
+        memmap_dir=None,
+        memmap_orig=True,
+        memmap_noise=True,
+        precision="float64",
     ):
         """
         Imports EEG data from a file, supporting various formats, and loads it into the EEG object.
@@ -58,22 +93,43 @@ class AnalysisFramework:
             upsampling_factor (int): The factor by which to upsample the data.
             fmt (str): The format of the EEG file (either "edf" or "gdf").
             bads (list): A list of bad channels to exclude from the data.
+            memmap_dir (str, optional): A scratch directory. If given, the data is loaded into a
+            memory-mapped file there instead of into memory, and all correction steps work on it.
+            memmap_orig (bool): Whether the untouched copy of the data is memory-mapped as well.
+            memmap_noise (bool): Whether the estimated noise is memory-mapped as well.
+            precision (str): "float64", or "float32" to keep the data, the estimated noise and the
+            intermediate results in single precision, which halves their memory.
 
         Returns:
             EEG: The EEG object containing the imported data and metadata.
         """
-        if fmt == "edf":
-            raw = mne.io.read_raw_edf(path)
-        elif fmt == "gdf":
-            raw = mne.io.read_raw_gdf(path)
-        elif fmt == "bids":
-            bids_path_i = BIDSPath(
-                subject=subject, session=session, task=task, root=path
+        if precision not in ("float64", "float32"):
+            raise ValueError(
+                f"Precision {precision!r} not supported, use 'float64' or 'float32'"
             )
-            raw = read_raw_bids(bids_path_i)
-        else:
-            raise ValueError("Format not supported")
-        raw.load_data()
+        preload = True
+        if memmap_dir is not None:
+            # MNE memory-maps the data to this file while reading it
+            fd, preload = tempfile.mkstemp(suffix=".dat", dir=memmap_dir)
+            os.close(fd)
+        try:
+            if fmt == "edf":
+                raw = mne.io.read_raw_edf(path, preload=preload)
+            elif fmt == "gdf":
+                raw = mne.io.read_raw_gdf(path, preload=preload)
+            elif fmt == "bids":
+                bids_path_i = BIDSPath(
+                    subject=subject, session=session, task=task, root=path
+                )
+                raw = read_raw_bids(bids_path_i, extra_params={"preload": preload})
+            else:
+                raise ValueError("Format not supported")
+        except BaseException:
+            if memmap_dir is not None:
+                _remove_file(preload)
+            raise
+        if memmap_dir is not None:
+            _remove_when_unmapped(raw._data, preload)
 
         all_channels = raw.ch_names
         exclude = [item for i, item in enumerate(all_channels) if item in bads]
@@ -81,14 +137,24 @@ class AnalysisFramework:
         data_time_start = raw.times[0]
         data_time_end = raw.times[-1]
 
+        if np.dtype(precision) != raw._data.dtype:
+            raw._data = store(raw._data, precision, memmap_dir)
         self._eeg = EEG(
             mne_raw=raw,
-            estimated_noise=np.zeros(raw._data.shape),
+            mne_raw_orig=(
+                self._copy_raw_to_memmap(raw, memmap_dir)
+                if memmap_dir is not None and memmap_orig
+                else None
+            ),
             artifact_to_trigger_offset=artifact_to_trigger_offset,
             upsampling_factor=upsampling_factor,
             data_time_start=data_time_start,
             data_time_end=data_time_end,
+            memmap_dir=memmap_dir,
+            memmap_noise=memmap_noise,
+            dtype=precision,
         )
+        self._eeg.estimated_noise = self._eeg.new_noise(raw._data.shape)
         events = self._try_to_get_events()
         if events is not None:
             self._eeg.all_events = events
@@ -103,6 +169,27 @@ class AnalysisFramework:
         logger.debug(path)
         return self._eeg
 
+    def _copy_raw_to_memmap(self, raw, memmap_dir):
+        """
+        Copies a raw object whose data is stored in a memory-mapped file in a directory.
+
+        Parameters:
+            raw (mne.io.Raw): The raw object.
+            memmap_dir (str): The directory of the file.
+
+        Returns:
+            mne.io.Raw: The copy.
+        """
+        data = raw._data
+        # the metadata is copied without the data, which is copied into the file
+        raw._data = np.zeros((data.shape[0], 0))
+        try:
+            copied = raw.copy()
+        finally:
+            raw._data = data
+        copied._data = store(data, data.dtype, memmap_dir)
+        return copied
+
     def export_eeg(
         self,
         path,
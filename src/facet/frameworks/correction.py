@@ -8,15 +8,27 @@ Date: 15.02.2024
 Version: 1.0
 """
 
+import os
+import threading
+from collections import Counter
 import numpy as np
 import mne
+from concurrent.futures import ThreadPoolExecutor
+from facet.eeg_obj import CompactNoise
 from facet.helpers.moosmann import calc_weighted_matrix_by_realignment_parameters_file
-from facet.helpers.fastranc import fastr_anc
-from facet.helpers.utils import split_vector
-from facet.helpers.crosscorr import crosscorrelation
+from facet.helpers.fastranc import fastr_anc_multichannel
+from facet.helpers.fdaf import fdaf_anc
+from facet.helpers.zerophase import fir_zero_phase
+from facet.helpers.utils import split_vector, epoch_view, epoch_starts
+from facet.helpers.crosscorr import (
+    crosscorrelation,
+    crosscorrelation_batched,
+    CrossCorrelationWorkspace,
+)
 from loguru import logger
-from scipy.signal import firls, filtfilt, fftconvolve
-
+from scipy.fft import rfft
+from scipy.signal import czt, firls, resample_poly
+from scipy.sparse import csr_array, diags_array, issparse
 
 # import inst for mne python
 
@@ -31,25 +43,35 @@ class CorrectionFramework:
     Attributes:
         _eeg (facet.eeg_obj): A dictionary containing the EEG metadata and data.
         _plot_number (int): A counter for the number of plots generated.
+        n_jobs (int): Number of threads the per-channel work is spread over.
         avg_artifact (numpy.ndarray): The average artifact matrix.
         avg_artifact_matrix (dict): A dictionary containing the average artifact matrix for each EEG channel.
-        avg_artifact_matrix_numpy (dict): A dictionary containing the average artifact matrix for each EEG channel as a numpy array.
+        avg_artifact_matrix_numpy (dict): A dictionary containing the average artifact matrix for each EEG channel as a numpy array or sparse matrix.
     """
 
-    def __init__(self, facet, eeg):
+    def __init__(self, facet, eeg, n_jobs=1):
         """
         Initializes the CorrectionFramework class with necessary components for EEG correction.
 
         Parameters:
             facet: A reference to a facet class instance, providing access to facet's functionalities.
             eeg: An EEG data structure, including metadata and raw EEG data.
+            n_jobs (int, optional): Number of threads the per-channel work is spread over. -1 uses all cores.
         """
         self._eeg = eeg
         self._facet = facet
+        self.n_jobs = n_jobs
         self._plot_number = 0
         self.avg_artifact = None
         self.avg_artifact_matrix = None
         self.avg_artifact_matrix_numpy = None
+        self._crosscorr_workspace = CrossCorrelationWorkspace()
+
+    # Upper bound for the epoch tensor of one channel block in calc_avg_artifact
+    _batch_bytes = 16 * 1024**2
+    # Native samples upsampled around the artifact windows, they keep the edges of the
+    # interpolation filter of resample_poly, which spans ten samples, out of the windows
+    _upsampling_margin = 10
 
     def cut(self):
         """
@@ -99,7 +121,31 @@ class CorrectionFramework:
         self._eeg = eeg
         return
 
-    def calc_avg_artifact(self, avg_artifact_matrix_numpy=None, plot_artifacts=False):
+    def _map_channels(self, func, items):
+        """
+        Applies a function to every item, spread over a thread pool if n_jobs is not 1.
+
+        The numpy operations of the per-channel work release the GIL, so the threads run
+        in parallel. The results are returned in the order of the items, so callers that
+        log while iterating over them keep their logs ordered.
+
+        Parameters:
+            func (callable): The function to apply.
+            items (iterable): The items, usually channels or blocks of channels.
+
+        Returns:
+            iterator: The results in the order of the items.
+        """
+        items = list(items)
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if n_jobs is None or n_jobs <= 1 or len(items) <= 1:
+            return map(func, items)
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(items))) as executor:
+            return iter(list(executor.map(func, items)))
+
+    def calc_avg_artifact(
+        self, avg_artifact_matrix_numpy=None, plot_artifacts=False, batched=True
+    ):
         """
         Calculates the average artifact for each channel.
 
@@ -108,6 +154,8 @@ class CorrectionFramework:
             it will be retrieved from the instance variable `avg_artifact_matrix_numpy`. If both are None,
             a ValueError will be raised.
             plot_artifacts (bool, optional): Whether to plot the artifacts. Defaults to False.
+            batched (bool, optional): Whether to average blocks of channels at once with a single batched
+            matrix multiplication instead of one multiplication per channel. Defaults to True.
 
         Raises:
             ValueError: If no artifact matrix is found.
@@ -135,42 +183,165 @@ class CorrectionFramework:
             raw_avg_artifact = mne.EvokedArray(
                 np.empty((len(channels_to_keep), int(art_length))), info
             )  # Only for optional plotting
-        counter = 0
-        artifacts = []
-        for ch_id, ch_matrix in avg_artifact_matrix_numpy.items():
-
-            logger.debug(
-                f"Calculating Artifact for Channel {ch_id}:{raw.ch_names[ch_id]}",
-                end=" ",
-            )
-            eeg_data_zero_mean = corrected_data_template[ch_id] - np.mean(
-                corrected_data_template[ch_id]
-            )
-            data_split_on_epochs = split_vector(
-                eeg_data_zero_mean,
+        if batched:
+            artifacts = self._calc_avg_artifact_batched(
+                avg_artifact_matrix_numpy,
                 np.array(self._eeg.loaded_triggers) + trigger_offset_in_samples,
                 art_length,
             )
-            # check if the number of epochs in matrix is equal to the number of triggers
-            if len(ch_matrix) != len(self._eeg.loaded_triggers):
-                # remove the last epoch from data_split_on_epochs
-                data_split_on_epochs = data_split_on_epochs[:-1]
-            avg_artifact = ch_matrix @ data_split_on_epochs
-            if len(ch_matrix) != len(self._eeg.loaded_triggers):
-                # copy last artifact to the end of the avg_artifact
-                avg_artifact = np.append(
-                    avg_artifact, avg_artifact[-1].reshape(1, -1), axis=0
+        else:
+            artifacts = []
+            for ch_id, ch_matrix in avg_artifact_matrix_numpy.items():
+
+                logger.debug(
+                    f"Calculating Artifact for Channel {ch_id}:{raw.ch_names[ch_id]}",
+                    end=" ",
+                )
+                eeg_data_zero_mean = corrected_data_template[ch_id] - np.mean(
+                    corrected_data_template[ch_id]
                 )
-            artifacts.append(avg_artifact)
+                data_split_on_epochs = epoch_view(
+                    eeg_data_zero_mean,
+                    np.array(self._eeg.loaded_triggers) + trigger_offset_in_samples,
+                    art_length,
+                )
+                # check if the number of epochs in matrix is equal to the number of triggers
+                if ch_matrix.shape[0] != len(self._eeg.loaded_triggers):
+                    # remove the last epoch from data_split_on_epochs
+                    data_split_on_epochs = data_split_on_epochs[:-1]
+                avg_artifact = ch_matrix @ data_split_on_epochs
+                if ch_matrix.shape[0] != len(self._eeg.loaded_triggers):
+                    # copy last artifact to the end of the avg_artifact
+                    avg_artifact = np.append(
+                        avg_artifact, avg_artifact[-1].reshape(1, -1), axis=0
+                    )
+                artifacts.append(avg_artifact)
 
-            if plot_artifacts:
-                raw_avg_artifact.data[counter] = avg_artifact[0]
-            counter += 1
         if plot_artifacts:
+            for counter, avg_artifact in enumerate(artifacts):
+                raw_avg_artifact.data[counter] = avg_artifact[0]
             raw_avg_artifact.plot()
         return artifacts
 
-    def remove_artifacts(self, avg_artifact_matrix_numpy=None, plot_artifacts=False):
+    def _calc_avg_artifact_batched(
+        self, avg_artifact_matrix_numpy, markers, art_length
+    ):
+        """
+        Calculates the average artifacts of all channels in blocks of channels.
+
+        The epochs of a block are gathered straight from the raw data into one reused
+        (epochs x channels x samples) tensor, so no full-length zero-mean copy of a
+        channel is made. Each block is averaged with a single batched matrix
+        multiplication, sparse matrices are multiplied channel by channel. Consecutive
+        channels that share the same matrix object, like the weighting matrix of
+        calc_matrix_motion, are averaged with one multiplication of the matrix with
+        the (epochs x channels*samples) tensor. Blocks are sized to keep the epoch
+        tensor within `_batch_bytes`. The result equals the per-channel computation.
+
+        Parameters:
+            avg_artifact_matrix_numpy (dict): The averaging matrix for each channel.
+            markers (numpy.ndarray): The start positions of the epochs in samples.
+            art_length (int): The length of an epoch in samples.
+
+        Returns:
+            list: The averaged artifacts (epochs x samples) for each channel.
+        """
+        data = self._eeg.mne_raw._data
+        n_triggers = len(self._eeg.loaded_triggers)
+        art_length = int(art_length)
+        markers = markers.astype(int)
+        n_times = data.shape[1]
+        # epochs running past the start or the end of the data
+        partial = np.flatnonzero((markers < 0) | (markers + art_length > n_times))
+
+        block_size = max(
+            1, self._batch_bytes // (len(markers) * art_length * data.itemsize)
+        )
+        n_users = Counter(id(matrix) for matrix in avg_artifact_matrix_numpy.values())
+        blocks = []
+        for ch_id, ch_matrix in avg_artifact_matrix_numpy.items():
+            shared = n_users[id(ch_matrix)] > 1
+            if blocks and len(blocks[-1]) < block_size:
+                block_matrix = avg_artifact_matrix_numpy[blocks[-1][0]]
+                if shared:
+                    compatible = block_matrix is ch_matrix
+                else:
+                    compatible = (
+                        n_users[id(block_matrix)] == 1
+                        and block_matrix.shape == ch_matrix.shape
+                        and issparse(block_matrix) == issparse(ch_matrix)
+                    )
+                if compatible:
+                    blocks[-1].append(ch_id)
+                    continue
+            blocks.append([ch_id])
+
+        # every thread reuses one buffer for the epochs of its blocks
+        local = threading.local()
+
+        def average_block(block):
+            if getattr(local, "buffer", None) is None:
+                local.buffer = np.empty(
+                    (len(markers), max(len(block) for block in blocks), art_length),
+                    dtype=data.dtype,
+                )
+            epochs = local.buffer[:, : len(block)]
+            for key, ch_id in enumerate(block):
+                epoch_view(data[ch_id], markers, art_length, out=epochs[:, key])
+                epochs[:, key] -= np.mean(data[ch_id], dtype=np.float64)
+            for i in partial:
+                positions = markers[i] + np.arange(art_length)
+                epochs[i, :, (positions < 0) | (positions >= n_times)] = 0
+            matrices = [avg_artifact_matrix_numpy[ch_id] for ch_id in block]
+            if data.dtype != np.float64:
+                # the weights in the precision of the data keep the products in it,
+                # a matrix shared by the channels stays shared
+                converted = {
+                    id(matrix): matrix.astype(data.dtype) for matrix in matrices
+                }
+                matrices = [converted[id(matrix)] for matrix in matrices]
+            n_epochs = matrices[0].shape[1]
+            # the matrix may lack the last epoch, which then gets the previous artifact
+            if len(block) > 1 and matrices[0] is matrices[1]:
+                stacked = epochs[:n_epochs].reshape(n_epochs, -1)
+                avg_artifacts = (matrices[0] @ stacked).reshape(
+                    -1, len(block), art_length
+                )
+                avg_artifacts = avg_artifacts.transpose(1, 0, 2)
+            elif issparse(matrices[0]):
+                avg_artifacts = [
+                    matrix @ epochs[:n_epochs, key]
+                    for key, matrix in enumerate(matrices)
+                ]
+            else:
+                avg_artifacts = np.matmul(
+                    np.stack(matrices), epochs[:n_epochs].transpose(1, 0, 2)
+                )
+            if n_epochs != n_triggers:
+                avg_artifacts = [
+                    np.append(avg_artifact, avg_artifact[-1].reshape(1, -1), axis=0)
+                    for avg_artifact in avg_artifacts
+                ]
+            return avg_artifacts
+
+        artifacts = []
+        for block, avg_artifacts in zip(
+            blocks, self._map_channels(average_block, blocks)
+        ):
+            for ch_id, avg_artifact in zip(block, avg_artifacts):
+                logger.debug(
+                    f"Calculating Artifact for Channel {ch_id}:{self._eeg.mne_raw.ch_names[ch_id]}",
+                    end=" ",
+                )
+                artifacts.append(avg_artifact)
+        return artifacts
+
+    def remove_artifacts(
+        self,
+        avg_artifact_matrix_numpy=None,
+        plot_artifacts=False,
+        local_upsampling=False,
+    ):
         """
         Removes artifacts from the EEG data.
 
@@ -179,6 +350,11 @@ class CorrectionFramework:
             it will be retrieved from the instance variable `avg_artifact_matrix_numpy`. If both are None,
             a ValueError will be raised.
             plot_artifacts (bool, optional): Whether to plot the artifacts. Defaults to False.
+            local_upsampling (bool, optional): Whether the data is at its native sampling rate and only the
+            windows around the artifacts are upsampled for averaging and alignment. This replaces the
+            upsample() and downsample() of the whole recording. Plotting is not supported in this mode
+            and only logs a warning.
+            Defaults to False.
 
         Raises:
             ValueError: If no artifact matrix is found.
@@ -189,6 +365,13 @@ class CorrectionFramework:
                     "No artifact matrix found. Please provide an artifact matrix by passing it as an argument or by calling the calc_matrix_aas method before calling remove_artifacts."
                 )
             avg_artifact_matrix_numpy = self.avg_artifact_matrix_numpy
+        if local_upsampling:
+            if plot_artifacts:
+                logger.warning(
+                    "Plotting the artifacts is not supported with local_upsampling, no plot is shown."
+                )
+            self._remove_artifacts_local(avg_artifact_matrix_numpy)
+            return
         raw = self._eeg.mne_raw
 
         artifacts = self.calc_avg_artifact(avg_artifact_matrix_numpy, plot_artifacts)
@@ -200,17 +383,377 @@ class CorrectionFramework:
             artifacts[0],
             search_window=3 * self._eeg.upsampling_factor,
         )
-        noise = self._eeg.estimated_noise
-        for i, ch_id in enumerate(avg_artifact_matrix_numpy.keys()):
+        # sample positions of all artifacts, the last window is clipped at the end of the data
+        width = min(smax - smin, artifacts[0].shape[1])
+        starts = np.array(aligned_triggers) + smin
+        positions = starts[:, np.newaxis] + np.arange(width)
+        inside = (positions >= 0) & (positions < raw._data.shape[1])
+        positions = positions[inside]
+        # overlapping windows need unbuffered in-place operations
+        overlapping = bool(np.any(np.diff(np.sort(starts)) < width))
+        ch_ids = list(avg_artifact_matrix_numpy.keys())
+        self._reserve_noise(ch_ids, positions)
+
+        def subtract(i):
+            self._subtract_artifact(
+                ch_ids[i], positions, artifacts[i][:, :width][inside], overlapping
+            )
+
+        for ch_id, _ in zip(ch_ids, self._map_channels(subtract, range(len(ch_ids)))):
+            logger.debug(
+                f"Removing Artifact from Channel {ch_id}:{raw.ch_names[ch_id]}"
+            )
+
+    def _remove_artifacts_local(self, avg_artifact_matrix_numpy):
+        """
+        Removes artifacts from EEG data at its native sampling rate with locally upsampled templates.
+
+        The windows around the artifacts are upsampled by the upsampling factor with a
+        polyphase filter. The averaged artifacts are built and the triggers of the first
+        channel are aligned on these windows, as remove_artifacts does on upsampled data.
+        Every shifted template is then decimated back onto the native sample grid and
+        subtracted there, so the recording itself is never upsampled.
+
+        Parameters:
+            avg_artifact_matrix_numpy (dict): The averaging matrix for each channel.
+        """
+        raw = self._eeg.mne_raw
+        data = raw._data
+        factor, search_window, smin, smax, art_length, width, starts = (
+            self._local_layout()
+        )
+        n_triggers = len(starts)
+
+        def upsampled_windows(ch_id):
+            mean = np.mean(data[ch_id], dtype=np.float64)
+            return self._upsampled_windows(ch_id, starts, mean), mean
+
+        def template(ch_id, windows):
+            matrix = avg_artifact_matrix_numpy[ch_id]
+            n_epochs = matrix.shape[1]
+            avg_artifact = matrix @ windows[:n_epochs, : art_length * factor]
+            if n_epochs != n_triggers:
+                # copy last artifact to the end of the avg_artifact
+                avg_artifact = np.append(
+                    avg_artifact, avg_artifact[-1].reshape(1, -1), axis=0
+                )
+            return avg_artifact
+
+        # the triggers are aligned on the upsampled windows of the first channel
+        ch_ids = list(avg_artifact_matrix_numpy.keys())
+        windows, mean = upsampled_windows(ch_ids[0])
+        corr = crosscorrelation_batched(
+            windows[:, : (smax - smin) * factor + search_window] + mean,
+            template(ch_ids[0], windows),
+            search_window,
+        )
+        shifts = np.argmax(corr, axis=1) - search_window
+        del windows
+
+        positions, columns, inside, overlapping = self._native_placement(starts, shifts)
+        self._reserve_noise(ch_ids, positions)
+
+        def subtract(ch_id):
+            avg_artifact = template(ch_id, upsampled_windows(ch_id)[0])
+            avg_artifact = np.take_along_axis(avg_artifact, columns, axis=1)
+            self._subtract_artifact(ch_id, positions, avg_artifact[inside], overlapping)
+
+        for ch_id, _ in zip(ch_ids, self._map_channels(subtract, ch_ids)):
             logger.debug(
                 f"Removing Artifact from Channel {ch_id}:{raw.ch_names[ch_id]}"
             )
-            for key, pos in enumerate(aligned_triggers):
-                start = pos + smin
-                stop = min(pos + smax, raw._data[ch_id].shape[0])
-                avg_artifact = artifacts[i][key, : stop - start]
-                noise[ch_id, start:stop] += avg_artifact
-                raw._data[ch_id][start:stop] -= avg_artifact
+
+    def _local_layout(self):
+        """
+        Returns the layout of the artifact windows that are upsampled locally.
+
+        Returns:
+            tuple: The upsampling factor, the search window of the alignment in upsampled
+            samples, the first and the last sample of the artifact relative to the trigger,
+            the artifact length, the number of native samples subtracted per artifact and the
+            first native sample of every artifact.
+        """
+        raw = self._eeg.mne_raw
+        factor = int(self._eeg.upsampling_factor)
+        smin, smax = raw.time_as_index(
+            [self._eeg.get_tmin(), self._eeg.get_tmax()], use_rounding=True
+        )
+        art_length = int(self._eeg.artifact_length)
+        width = min(smax - smin, art_length)
+        starts = np.array(self._eeg.loaded_triggers) + smin
+        return factor, 3 * factor, smin, smax, art_length, width, starts
+
+    def _upsampled_windows(self, ch_id, starts, mean):
+        """
+        Returns the mean-free windows at the given artifact starts of a channel, upsampled.
+
+        Parameters:
+            ch_id (int): The index of the channel.
+            starts (numpy.ndarray): The first native sample of every artifact.
+            mean (float): The mean of the channel that is subtracted.
+
+        Returns:
+            numpy.ndarray: The upsampled windows, (artifacts x samples).
+        """
+        factor, search_window, _, _, art_length, _, _ = self._local_layout()
+        margin = self._upsampling_margin
+        length = art_length + 2 * margin + -(-search_window // factor)
+        windows = epoch_view(self._eeg.mne_raw._data[ch_id], starts - margin, length)
+        windows = resample_poly(windows - mean, factor, 1, axis=-1)
+        return windows[:, margin * factor :]
+
+    def _native_placement(self, starts, shifts):
+        """
+        Places shifted upsampled templates on the native sample grid.
+
+        Parameters:
+            starts (numpy.ndarray): The first native sample of every artifact.
+            shifts (numpy.ndarray): The alignment shift of every artifact in upsampled samples.
+
+        Returns:
+            tuple: The native sample positions of the subtracted values that lie within the
+            data, the template columns decimated onto them (artifacts x width), the mask of
+            these columns that lies within the data, and whether the positions overlap.
+        """
+        factor, _, _, _, _, width, _ = self._local_layout()
+        # the first template sample on the native grid and the native sample it lands on
+        first = -shifts % factor
+        native_starts = starts + (first + shifts) // factor
+        columns = first[:, np.newaxis] + factor * np.arange(width)
+        positions = native_starts[:, np.newaxis] + np.arange(width)
+        inside = (positions >= 0) & (positions < self._eeg.mne_raw.n_times)
+        overlapping = bool(np.any(np.diff(np.sort(native_starts)) < width))
+        return positions[inside], columns, inside, overlapping
+
+    def remove_artifacts_chunked(
+        self, rel_window_position=0, window_size=30, block_size=300, channels=None
+    ):
+        """
+        Averages and removes the artifacts block by block with bounded intermediate memory.
+
+        Gives the result of calc_matrix_aas followed by remove_artifacts with
+        local_upsampling on data at its native sampling rate, but only holds the epochs of
+        one block of triggers at a time. A block starts at a multiple of the window size
+        and also reads the context epochs the shifted averaging windows reach into before
+        and after it, so the templates at the block boundaries are the same as in the
+        in-memory path. The channel means are taken in a blockwise pass over the data
+        beforehand. The corrections of a block are written to the data as soon as no
+        later block reads the samples they change, so every block sees uncorrected data.
+        The averaging matrices, the upsampled windows and the pending corrections grow
+        with block_size and not with the recording.
+
+        The peak memory is only bounded by block_size if the data was imported with
+        memmap_dir, so the data and the estimated noise live in files of which only the
+        pages of the current blocks are read into memory. Data held in memory is
+        corrected the same way, but the whole recording stays resident, as it does for
+        the import, the upsampling and the ANC, and a warning is logged.
+
+        Parameters:
+            rel_window_position (int, optional): Relative window position for artifact averaging.
+            window_size (int, optional): Size of the window for artifact averaging. Defaults to 30.
+            block_size (int, optional): Number of triggers per block, rounded down to a multiple of
+            window_size. Defaults to 300.
+            channels (list, optional): Channels to correct. If None, all EEG channels are used.
+        """
+        raw = self._eeg.mne_raw
+        eeg_channels = mne.pick_types(
+            raw.info, meg=False, eeg=True, stim=False, eog=False, exclude="bads"
+        )
+        ch_ids = [int(i) for i in (eeg_channels if channels is None else channels)]
+        if not isinstance(raw._data, np.memmap):
+            logger.warning(
+                "The data is held in memory, the memory of remove_artifacts_chunked is only bounded by block_size for data imported with memmap_dir."
+            )
+        factor, search_window, smin, smax, art_length, width, starts = (
+            self._local_layout()
+        )
+        n_triggers = len(starts)
+        epoch_starts, n_samples = self._epoch_starts(raw, picks=eeg_channels)
+        n_epochs = len(epoch_starts)
+        if n_epochs != n_triggers:
+            logger.warning(
+                "Number of epochs is not equal to the number of triggers. Please check your data. Imcomplete data?"
+            )
+        means = self._channel_means(ch_ids)
+
+        # epochs the averaging windows of a block reach into beyond the block
+        window_offset = int(window_size * rel_window_position)
+        before = -(-max(-window_offset, 0) // window_size) * window_size
+        after = max(window_offset, 0) + window_size
+        block_size = max(block_size // window_size, 1) * window_size
+
+        blocks = []
+        for first in range(0, n_triggers, block_size):
+            triggers = np.arange(first, min(first + block_size, n_triggers))
+            # triggers without an epoch use the template of the last epoch
+            rows = np.minimum(triggers, n_epochs - 1)
+            low = max(rows[0] // window_size * window_size - before, 0)
+            high = min(rows[-1] // window_size * window_size + after, n_epochs)
+            windows = slice(min(low, triggers[0]), max(high, triggers[-1] + 1))
+            read_start = min(
+                epoch_starts[low], starts[windows.start] - self._upsampling_margin
+            )
+            blocks.append((triggers, rows, low, high, windows, read_start))
+
+        pending = []
+        for i, (triggers, rows, low, high, windows, _) in enumerate(blocks):
+
+            def template(ch_id, matrix):
+                upsampled = self._upsampled_windows(
+                    ch_id, starts[windows], means[ch_ids.index(ch_id)]
+                )
+                epochs = upsampled[low - windows.start : high - windows.start]
+                return matrix @ epochs[:, : art_length * factor], upsampled
+
+            chosen_matrices = self.calc_chosen_matrices(
+                np.stack(
+                    [
+                        epoch_view(raw._data[ch_id], epoch_starts[low:high], n_samples)
+                        for ch_id in ch_ids
+                    ]
+                ),
+                rel_window_offset=rel_window_position,
+                window_size=window_size,
+            )
+            matrices = {
+                ch_id: chosen_matrix[rows - low]
+                for ch_id, chosen_matrix in zip(ch_ids, chosen_matrices)
+            }
+            avg_artifact, upsampled = template(ch_ids[0], matrices[ch_ids[0]])
+            aligned = upsampled[
+                triggers[0] - windows.start : triggers[-1] + 1 - windows.start
+            ]
+            corr = crosscorrelation_batched(
+                aligned[:, : (smax - smin) * factor + search_window] + means[0],
+                avg_artifact,
+                search_window,
+            )
+            shifts = np.argmax(corr, axis=1) - search_window
+            positions, columns, inside, overlapping = self._native_placement(
+                starts[triggers], shifts
+            )
+
+            def values(ch_id):
+                avg_artifact = template(ch_id, matrices[ch_id])[0]
+                return np.take_along_axis(avg_artifact, columns, axis=1)[inside]
+
+            pending.append(
+                (
+                    positions,
+                    np.stack(list(self._map_channels(values, ch_ids))),
+                    overlapping,
+                )
+            )
+            del matrices, upsampled, aligned
+            logger.debug(
+                f"Removed artifacts of triggers {triggers[0]} to {triggers[-1]}"
+            )
+
+            # samples before the first one read by the next block are final
+            limit = blocks[i + 1][-1] if i + 1 < len(blocks) else raw.n_times
+            pending = self._apply_corrections(ch_ids, pending, limit)
+
+    def _channel_means(self, ch_ids, block_samples=2**20):
+        """
+        Returns the means of channels, summed block by block to bound the memory.
+
+        Parameters:
+            ch_ids (list): The indices of the channels.
+            block_samples (int, optional): Number of samples per block.
+
+        Returns:
+            numpy.ndarray: The mean of every channel.
+        """
+        data = self._eeg.mne_raw._data
+        sums = np.zeros(len(ch_ids))
+        for start in range(0, data.shape[1], block_samples):
+            sums += np.sum(
+                data[ch_ids, start : start + block_samples], axis=1, dtype=np.float64
+            )
+        return sums / data.shape[1]
+
+    def _apply_corrections(self, ch_ids, pending, limit):
+        """
+        Subtracts the pending artifact values before a sample and returns the rest.
+
+        Parameters:
+            ch_ids (list): The indices of the channels.
+            pending (list): Tuples of positions, values (channels x positions) and whether the
+            positions overlap, in trigger order.
+            limit (int): The first sample that is not corrected yet.
+
+        Returns:
+            list: The pending values at or after the limit.
+        """
+        remaining = []
+        for positions, values, overlapping in pending:
+            now = positions < limit
+            self._reserve_noise(ch_ids, positions[now])
+
+            def subtract(i):
+                self._subtract_artifact(
+                    ch_ids[i], positions[now], values[i][now], overlapping
+                )
+
+            list(self._map_channels(subtract, range(len(ch_ids))))
+            if not now.all():
+                remaining.append((positions[~now], values[:, ~now], overlapping))
+        return remaining
+
+    def _subtract_artifact(self, ch_id, positions, avg_artifact, overlapping):
+        """
+        Subtracts the artifacts of a channel from the data and adds them to the estimated noise.
+
+        Parameters:
+            ch_id (int): The index of the channel.
+            positions (numpy.ndarray): The sample position of every artifact value.
+            avg_artifact (numpy.ndarray): The artifact values, flattened like positions.
+            overlapping (bool): Whether positions contains samples more than once.
+        """
+        data = self._eeg.mne_raw._data[ch_id]
+        self._eeg.estimated_noise.add(ch_id, positions, avg_artifact, overlapping)
+        if overlapping:
+            # applies the values one after another in trigger order
+            np.subtract.at(data, positions, avg_artifact)
+        else:
+            data[positions] -= avg_artifact
+
+    def _noise(self):
+        """
+        Returns the estimated noise as a CompactNoise, converting a dense array if one was set.
+
+        Returns:
+            CompactNoise: The estimated noise.
+        """
+        noise = self._eeg.estimated_noise
+        if noise is None:
+            self._eeg.estimated_noise = self._eeg.new_noise(
+                self._eeg.mne_raw._data.shape
+            )
+        elif not isinstance(noise, CompactNoise):
+            self._eeg.estimated_noise = CompactNoise.from_dense(
+                np.asarray(noise), self._eeg.dtype
+            )
+        return self._eeg.estimated_noise
+
+    def _reserve_noise(self, ch_ids, positions):
+        """
+        Makes room in the estimated noise for the artifacts of channels, before threads write them.
+
+        Parameters:
+            ch_ids (list): The indices of the channels.
+            positions (numpy.ndarray): The sample positions of the artifact values.
+        """
+        if len(positions) == 0:
+            return
+        # one window for every run of samples, the windows of artifacts that touch are joined
+        samples = np.unique(positions)
+        breaks = np.flatnonzero(np.diff(samples) > 1)
+        noise = self._noise()
+        for first, last in zip(
+            samples[np.r_[0, breaks + 1]], samples[np.r_[breaks, -1]]
+        ):
+            noise.reserve(ch_ids, first, last + 1)
 
     def calc_matrix_aas(self, rel_window_position=0, window_size=30, channels=None):
         """
@@ -236,36 +779,55 @@ class CorrectionFramework:
         else:
             channels_to_average = [raw.ch_names[i] for i in channels[:]]
         # Epochen erstellen
-        epochs = mne.Epochs(
-            raw,
-            events=self._eeg.triggers_as_events,
-            tmin=self._eeg.get_tmin(),
-            tmax=self._eeg.get_tmax(),
-            baseline=None,
-            reject=None,
-            preload=True,
-            picks=eeg_channels,
-        )
-        if len(epochs) != len(self._eeg.loaded_triggers):
+        starts, n_samples = self._epoch_starts(raw, picks=eeg_channels)
+        if len(starts) != len(self._eeg.loaded_triggers):
             # Because of possible bad triggers, we need to check if the number of epochs is equal to the number of triggers
             logger.warning(
                 "Number of epochs is not equal to the number of triggers. Please check your data. Imcomplete data?"
             )
+
+        # the epochs of a block of channels are chosen at once, within _batch_bytes
+        block_size = max(
+            1, self._batch_bytes // (len(starts) * n_samples * raw._data.itemsize)
+        )
         avg_matrix_3d = {}
-        for key, ch_name in enumerate(channels_to_average):
-            idx = self._eeg.mne_raw.ch_names.index(ch_name)
-            logger.debug(f"Averaging Channel {idx}:{ch_name}", end=" ")
-            epochs_single_channel = np.squeeze(epochs._data[:, key, :])
-            chosen_matrix = self.calc_chosen_matrix(
-                epochs_single_channel,
+        for first in range(0, len(channels_to_average), block_size):
+            block = channels_to_average[first : first + block_size]
+            indices = [raw.ch_names.index(ch_name) for ch_name in block]
+            epochs = np.stack(
+                [epoch_view(raw._data[idx], starts, n_samples) for idx in indices]
+            )
+            chosen_matrices = self.calc_chosen_matrices(
+                epochs,
                 rel_window_offset=rel_window_position,
                 window_size=window_size,
             )
-            avg_matrix_3d[idx] = chosen_matrix
+            for idx, ch_name, chosen_matrix in zip(indices, block, chosen_matrices):
+                logger.debug(f"Averaging Channel {idx}:{ch_name}", end=" ")
+                avg_matrix_3d[idx] = chosen_matrix
 
         self.avg_artifact_matrix_numpy = avg_matrix_3d
         return avg_matrix_3d
 
+    def _epoch_starts(self, raw, picks=None):
+        """
+        Returns the first samples of the epochs mne.Epochs would create around the triggers.
+
+        Parameters:
+            raw (mne.io.Raw): The raw data the epochs are taken from.
+            picks (list, optional): The channels checked for BAD annotations.
+
+        Returns:
+            tuple: The first sample of each kept epoch in raw._data and the number of samples per epoch.
+        """
+        return epoch_starts(
+            raw,
+            self._eeg.triggers_as_events,
+            self._eeg.get_tmin(),
+            self._eeg.get_tmax(),
+            picks=picks,
+        )
+
     def highly_correlated_epochs_with_indices(
         self, full_epochs, epoch_indices, epochs_indices_reference, threshold=0.975
     ):
@@ -285,18 +847,33 @@ class CorrectionFramework:
         if len(epochs_indices_reference) == 0:
             return np.array([])
 
-        sum_data = np.sum(full_epochs[epochs_indices_reference], axis=0)
+        # The correlation does not depend on the scale of the average, so the
+        # mean-centered sum of the chosen epochs is used as reference. Its dot
+        # products with all mean-centered candidates are updated per acceptance.
+        candidates = full_epochs[epoch_indices].astype(np.float64, copy=False)
+        candidates = candidates - np.mean(candidates, axis=1, keepdims=True)
+        candidate_norms = np.linalg.norm(candidates, axis=1)
+        sum_data = np.sum(
+            full_epochs[epochs_indices_reference], axis=0, dtype=np.float64
+        )
+        sum_data = sum_data - np.mean(sum_data)
+        sum_norm = np.linalg.norm(sum_data)
+        scores = candidates @ sum_data
         chosen = list(epochs_indices_reference)
+        chosen_set = set(chosen)
         # Check subsequent epochs
-        for idx in epoch_indices:
+        for key, idx in enumerate(epoch_indices):
             # check if idx is already in chosen
-            if idx in chosen:
+            if idx in chosen_set:
                 continue
-            avg_data = sum_data / len(chosen)
-            corr = np.corrcoef(avg_data.squeeze(), full_epochs[idx].squeeze())[0, 1]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                corr = scores[key] / (candidate_norms[key] * sum_norm)
             if corr > threshold:
-                sum_data += full_epochs[idx]
+                sum_data += candidates[key]
+                sum_norm = np.linalg.norm(sum_data)
+                scores = candidates @ sum_data
                 chosen.append(idx)
+                chosen_set.add(idx)
 
         return np.array(chosen)
 
@@ -313,11 +890,41 @@ class CorrectionFramework:
             rel_window_offset (float): Relative offset of the window.
 
         Returns:
-            numpy.ndarray: The chosen matrix.
+            scipy.sparse.csr_array: The chosen matrix. Only the chosen epochs of each window are stored,
+            so its size grows linearly with the number of epochs.
+        """
+        return self.calc_chosen_matrices(
+            np.asarray(epochs)[np.newaxis],
+            threshold=threshold,
+            window_size=window_size,
+            rel_window_offset=rel_window_offset,
+        )[0]
+
+    def calc_chosen_matrices(
+        self, epochs, threshold=0.975, window_size=30, rel_window_offset=0
+    ):
+        """
+        Calculates the chosen matrices of several channels at once.
+
+        Equals calc_chosen_matrix for every channel, but the greedy choice of the epochs
+        of a window runs for all channels together, one step per candidate epoch, so
+        the number of Python steps does not grow with the number of channels.
+
+        Parameters:
+            epochs (numpy.ndarray): The (channels x epochs x samples) epochs.
+            threshold (float): Threshold value for correlation.
+            window_size (int): Size of the window for calculating correlations.
+            rel_window_offset (float): Relative offset of the window.
+
+        Returns:
+            list: The chosen matrix (scipy.sparse.csr_array) of every channel.
         """
-        n_epochs = len(epochs)
+        n_channels, n_epochs = epochs.shape[:2]
 
-        chosen_matrix = np.zeros((n_epochs, n_epochs))
+        # coordinates and values of the non-zero entries of every channel
+        rows = [[np.array([], dtype=int)] for _ in range(n_channels)]
+        cols = [[np.array([], dtype=int)] for _ in range(n_channels)]
+        weights = [[np.array([])] for _ in range(n_channels)]
 
         window_offset = int(
             window_size * rel_window_offset
@@ -330,15 +937,67 @@ class CorrectionFramework:
             candidates = np.arange(offset_idx, min(offset_idx + window_size, n_epochs))
             # remove all negative indices
             candidates = candidates[candidates >= 0]
-            chosen = self.highly_correlated_epochs_with_indices(
+            accepted = self._highly_correlated_epochs_batched(
                 epochs, candidates, reference_indices, threshold=threshold
             )
-            if len(chosen) == 0:
-                continue
             indices = np.arange(idx, min(idx + window_size, n_epochs))
-            chosen_matrix[np.ix_(indices, chosen)] = 1 / len(chosen)
+            for ch in range(n_channels):
+                chosen = np.concatenate((reference_indices, candidates[accepted[ch]]))
+                rows[ch].append(np.repeat(indices, len(chosen)))
+                cols[ch].append(np.tile(chosen, len(indices)))
+                weights[ch].append(np.full(len(indices) * len(chosen), 1 / len(chosen)))
+
+        return [
+            csr_array(
+                (
+                    np.concatenate(weights[ch]),
+                    (np.concatenate(rows[ch]), np.concatenate(cols[ch])),
+                ),
+                shape=(n_epochs, n_epochs),
+            )
+            for ch in range(n_channels)
+        ]
+
+    def _highly_correlated_epochs_batched(
+        self, epochs, epoch_indices, epochs_indices_reference, threshold=0.975
+    ):
+        """
+        Chooses the highly correlated epochs of several channels like highly_correlated_epochs_with_indices.
+
+        The reference epochs are always chosen. The candidates are checked in order
+        against the sum of the epochs chosen so far, for all channels at once.
+
+        Parameters:
+            epochs (numpy.ndarray): The (channels x epochs x samples) epochs.
+            epoch_indices (numpy.ndarray): The indices of epochs to be checked for correlation.
+            epochs_indices_reference (numpy.ndarray): The indices of reference epochs, not empty.
+            threshold (float, optional): The correlation threshold. Defaults to 0.975.
 
-        return chosen_matrix
+        Returns:
+            numpy.ndarray: Whether each candidate that is not a reference epoch is chosen, (channels x candidates).
+        """
+        candidates = epochs[:, epoch_indices].astype(np.float64)
+        candidates -= np.mean(candidates, axis=2, keepdims=True)
+        # Adding a candidate to the sum changes the dot products with the sum by its
+        # dot products with the candidates, so they are updated from the Gram matrix.
+        gram = candidates @ candidates.transpose(0, 2, 1)
+        candidate_norms = np.sqrt(np.einsum("ckk->ck", gram))
+        sum_data = np.sum(epochs[:, epochs_indices_reference], axis=1, dtype=np.float64)
+        sum_data -= np.mean(sum_data, axis=1, keepdims=True)
+        sum_squares = np.einsum("cs,cs->c", sum_data, sum_data)
+        scores = (candidates @ sum_data[:, :, np.newaxis])[:, :, 0]
+        is_reference = np.isin(epoch_indices, epochs_indices_reference)
+        accepted = np.zeros(scores.shape, dtype=bool)
+        for key in np.flatnonzero(~is_reference):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                corr = scores[:, key] / (candidate_norms[:, key] * np.sqrt(sum_squares))
+            accept = corr > threshold
+            if not accept.any():
+                continue
+            accepted[accept, key] = True
+            sum_squares[accept] += 2 * scores[accept, key] + gram[accept, key, key]
+            scores[accept] += gram[accept, key]
+        return accepted
 
     def calc_matrix_motion(self, file_path, window_size=30, threshold=5):
         """
@@ -365,19 +1024,25 @@ class CorrectionFramework:
 
         avg_artifact_matrix_every_channel = {}
         # ensure every row in weighting matrix sums up to 1
-        weighting_matrix = (
-            weighting_matrix / np.sum(weighting_matrix, axis=1)[:, np.newaxis]
+        weighting_matrix = csr_array(
+            diags_array(1 / weighting_matrix.sum(axis=1)) @ weighting_matrix
         )
-        # add weighting matrix to every channel
+        # every channel shares the same matrix object, which is stored only once and lets
+        # calc_avg_artifact average all channels with a single multiplication
         for idx in eeg_channel_indices:
             avg_artifact_matrix_every_channel[idx] = weighting_matrix
 
         self.avg_artifact_matrix_numpy = avg_artifact_matrix_every_channel
         return avg_artifact_matrix_every_channel
 
-    def apply_ANC(self):
+    def apply_ANC(self, method="fastranc"):
         """
         Applies Adaptive Noise Cancellation (ANC) to clean the EEG data from each channel.
+
+        Parameters:
+            method (str, optional): The adaptive filter. "fastranc" adapts an LMS filter sample by sample
+            in C, "fdaf" adapts it block by block in the frequency domain, which is faster for long
+            filters. Defaults to "fastranc".
         """
 
         logger.debug("applying ANC")
@@ -392,9 +1057,31 @@ class CorrectionFramework:
                 logger.debug(
                     f"Applying ANC to Channel {ch_id}:{channel_names_to_modify[key]}"
                 )
-                raw._data[ch_id] = self._anc(
-                    raw._data[ch_id], self._eeg.estimated_noise[key]
-                )
+            acq_start, acq_end = self._acquisition_window()
+            # The channels are filtered in blocks, spread over n_jobs threads. A block
+            # holds as many channels as threads, more if about eight buffers of the
+            # acquisition window of its channels fit into _batch_bytes.
+            n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+            block_size = max(
+                n_jobs or 1,
+                self._batch_bytes // (8 * max(acq_end - acq_start, 1) * 8),
+            )
+            noise = self._noise()
+            for first in range(0, len(eeg_channels), block_size):
+                block = eeg_channels[first : first + block_size]
+                if np.all(np.diff(block) == 1):
+                    # consecutive channels are filtered in place
+                    self._anc(
+                        raw._data[block[0] : block[-1] + 1],
+                        noise.rows(block, acq_start, acq_end),
+                        method=method,
+                    )
+                else:
+                    data = raw._data[block]
+                    self._anc(
+                        data, noise.rows(block, acq_start, acq_end), method=method
+                    )
+                    raw._data[block] = data
 
         except Exception as ex:
             logger.exception("An exception occured while applying ANC", ex)
@@ -544,10 +1231,8 @@ class CorrectionFramework:
 
                 # HPEEG signal filtering
                 # Original MATLAB code used fftfilt which is equivalent to scipy's fftconvolve in "same" mode
-                hpeeg = fftconvolve(raeeg_acq, fw, mode="same")
-                hpeeg = np.concatenate(
-                    [hpeeg[100:], np.zeros(100)]
-                )  # Adjusting the shift
+                hpeeg = fir_zero_phase(raeeg_acq, fw, start=100, passes=1)
+                hpeeg = np.concatenate([hpeeg, np.zeros(100)])  # Adjusting the shift
             else:
                 hpeeg = raeeg_acq
 
@@ -632,35 +1317,86 @@ class CorrectionFramework:
         result = -np.sum((ref - arg) ** 2)
         return result
 
-    def _anc(self, EEG, Noise):
+    def _acquisition_window(self):
         """
-        Internal method for Adaptive Noise Cancellation.
-
-        Parameters:
-            EEG (numpy.ndarray): The EEG data to be cleaned.
-            Noise (numpy.ndarray): The noise data used as reference for ANC.
+        Returns the first and the end sample of the acquisition, the window the ANC cleans.
 
         Returns:
-            numpy.ndarray: The cleaned EEG data.
+            tuple: The first sample and the end of the window.
         """
         acq_start, acq_end = self._eeg.mne_raw.time_as_index(
             [self._eeg.time_first_artifact_start, self._eeg.time_last_artifact_end],
             use_rounding=True,
         )
-        Reference = Noise[acq_start:acq_end]
+        return int(acq_start), int(acq_end)
+
+    def _anc(self, EEG, Noise, method="fastranc"):
+        """
+        Internal method for Adaptive Noise Cancellation.
+
+        The EEG data is cleaned in place.
+
+        Parameters:
+            EEG (numpy.ndarray): The EEG data to be cleaned, one channel or (channels x samples).
+            Noise (numpy.ndarray): The noise data used as reference for ANC, in the shape of EEG or
+            only of its acquisition window.
+            method (str, optional): The adaptive filter, "fastranc" or "fdaf". Defaults to "fastranc".
+
+        Returns:
+            numpy.ndarray: The cleaned EEG data.
+        """
+        acq_start, acq_end = self._acquisition_window()
+        Reference = Noise
+        if Noise.shape[-1] != acq_end - acq_start:
+            Reference = Noise[..., acq_start:acq_end]
         # plt.plot(Reference[0:self._eeg.artifact_length])
-        tmpd = filtfilt(self._eeg.anc_hp_filter_weights, 1, EEG, axis=0, padtype="odd")
-        Data = tmpd[acq_start:acq_end].astype(float)
-        Alpha = np.sum(Data * Reference) / np.sum(Reference * Reference)
-        Reference = (Alpha * Reference).astype(float)
-        mu = float(0.05 / (self._eeg.anc_filter_order * np.var(Reference)))
+        # only the acquisition window is high-pass filtered, like filtfilt would
+        tmpd = fir_zero_phase(
+            EEG, self._eeg.anc_hp_filter_weights, start=acq_start, stop=acq_end
+        )
+        # single precision data is filtered in single precision, the sums are double
+        Data = np.atleast_2d(tmpd.astype(EEG.dtype, copy=False))
+        Reference = np.atleast_2d(Reference)
+        Alpha = np.einsum("ij,ij->i", Data, Reference, dtype=np.float64) / np.einsum(
+            "ij,ij->i", Reference, Reference, dtype=np.float64
+        )
+        Reference = np.multiply(Alpha[:, np.newaxis], Reference, dtype=Data.dtype)
+        mu = 0.05 / (
+            self._eeg.anc_filter_order * np.var(Reference, axis=-1, dtype=np.float64)
+        )
 
         # Use the fastranc function for adaptive noise cancellation
-        _, FilteredNoise = fastr_anc(Reference, Data, self._eeg.anc_filter_order, mu)
-        if np.isinf(np.max(FilteredNoise)):
-            logger.error("Warning: ANC failed, skipping ANC.")
+        if method == "fastranc":
+            _, FilteredNoise = fastr_anc_multichannel(
+                Reference,
+                Data,
+                self._eeg.anc_filter_order,
+                mu,
+                n_jobs=self.n_jobs,
+            )
+        elif method == "fdaf":
+            FilteredNoise = np.array(
+                list(
+                    self._map_channels(
+                        lambda ch: fdaf_anc(
+                            Reference[ch],
+                            Data[ch],
+                            self._eeg.anc_filter_order,
+                            float(mu[ch]),
+                        )[1],
+                        range(len(Data)),
+                    )
+                )
+            )
         else:
-            EEG[acq_start:acq_end] -= FilteredNoise
+            raise ValueError(f"Unknown ANC method {method}")
+        failed = np.isinf(np.max(FilteredNoise, axis=-1))
+        if np.any(failed):
+            logger.error("Warning: ANC failed, skipping ANC.")
+        FilteredNoise[failed] = 0
+        EEG[..., acq_start:acq_end] -= FilteredNoise.reshape(
+            EEG[..., acq_start:acq_end].shape
+        )
 
         return EEG
 
@@ -680,22 +1416,21 @@ class CorrectionFramework:
         """
         if search_window is None:
             search_window = 3 * self._eeg.upsampling_factor
-        new_triggers = []
         smin = int(self._eeg.get_tmin() * self._eeg.mne_raw.info["sfreq"])
         smax = int(self._eeg.get_tmax() * self._eeg.mne_raw.info["sfreq"])
-        for i in range(self._eeg.count_triggers):
-            base = ch_d[
-                self._eeg.loaded_triggers[i]
-                + smin : self._eeg.loaded_triggers[i]
-                + smax
-                + search_window
-            ]
-            Beta = self._find_max_cross_correlation(
-                base, avg_artifact[i, :], search_window
+        triggers = np.array(self._eeg.loaded_triggers[: self._eeg.count_triggers])
+        window = smax - smin + search_window
+        # all windows of a block are correlated with their averaged artifact at once
+        block_size = max(1, self._batch_bytes // (32 * (window + search_window)))
+        shifts = np.empty(len(triggers), dtype=int)
+        for start in range(0, len(triggers), block_size):
+            stop = min(start + block_size, len(triggers))
+            bases = epoch_view(ch_d, triggers[start:stop] + smin, window)
+            corr = crosscorrelation_batched(
+                bases, avg_artifact[start:stop], search_window
             )
-            shift = Beta - search_window
-            new_triggers.append(self._eeg.loaded_triggers[i] + shift)
-        return new_triggers
+            shifts[start:stop] = np.argmax(corr, axis=1) - search_window
+        return (triggers + shifts).tolist()
 
     def downsample(self):
         """
@@ -730,20 +1465,83 @@ class CorrectionFramework:
         """
 
         logger.debug(f"Applying filter with l_freq={l_freq} and h_freq={h_freq}")
-        # performant check if the estimated noise is all zeros with any
-        if np.any(self._eeg.estimated_noise):
-            # Apply highpass filter
-
-            # TODO: Consider changing estimated_noise to a mne object, to avoid copying
-            noise_raw = self._eeg.mne_raw.copy()
-            noise_raw._data = self._eeg.estimated_noise
-            self._eeg.estimated_noise = noise_raw.filter(
-                l_freq=l_freq, h_freq=h_freq
-            )._data.copy()
-            # unload noise_raw
-            noise_raw = None
+        noise = self._noise()
+        if noise.any():
+            # Only the stored windows of the noise are filtered, one span at a time. They
+            # are padded with the zeros around them for the length of the filter, beyond
+            # which nothing spreads.
+            length = len(
+                mne.filter.create_filter(
+                    None, self._eeg.mne_raw.info["sfreq"], l_freq, h_freq
+                )
+            )
+            noise_info = mne.pick_info(self._eeg.mne_raw.info, noise.channels)
+            filtered = self._eeg.new_noise(noise.shape)
+            for start, stop in noise.spans(length):
+                noise_raw = mne.io.RawArray(
+                    noise.rows(noise.channels, start, stop), noise_info, verbose=False
+                )
+                filtered.add_block(
+                    noise.channels,
+                    start,
+                    noise_raw.filter(l_freq=l_freq, h_freq=h_freq)._data,
+                )
+                # unload noise_raw
+                noise_raw = None
+            self._eeg.estimated_noise = filtered
+        data = self._eeg.mne_raw._data
+        if data.dtype != np.float64 or isinstance(data, np.memmap):
+            info = self._filter_blocks(data, l_freq, h_freq)
+            with self._eeg.mne_raw.info._unlock():
+                self._eeg.mne_raw.info["highpass"] = info["highpass"]
+                self._eeg.mne_raw.info["lowpass"] = info["lowpass"]
+            return
         self._eeg.mne_raw.filter(l_freq=l_freq, h_freq=h_freq)
 
+    def _filter_blocks(self, data, l_freq, h_freq):
+        """
+        Filters data in place like raw.filter, one block of channels at a time.
+
+        Every block of data channels is filtered as a double precision copy in a raw
+        object of its own and written back. Memory-mapped data thereby stays in its file
+        and only one block is held in memory, and single precision data, which MNE does
+        not filter, is filtered in double precision.
+
+        Parameters:
+            data (numpy.ndarray): The (channels x samples) data in the channel order of the raw object.
+            l_freq (float): The lower cutoff frequency, or None.
+            h_freq (float): The higher cutoff frequency, or None.
+
+        Returns:
+            mne.Info: The info of a filtered block, with the new highpass and lowpass.
+        """
+        raw = self._eeg.mne_raw
+        info = raw.info
+        picks = mne.pick_types(
+            raw.info,
+            meg=True,
+            eeg=True,
+            seeg=True,
+            ecog=True,
+            dbs=True,
+            fnirs=True,
+            exclude=[],
+        )
+        n_block = max(self._batch_bytes // (8 * data.shape[1]), 1)
+        for first in range(0, len(picks), n_block):
+            block = picks[first : first + n_block]
+            channels = mne.io.RawArray(
+                data[block].astype(np.float64),
+                mne.pick_info(raw.info, block),
+                first_samp=raw.first_samp,
+                verbose=False,
+            )
+            channels.set_annotations(raw.annotations)
+            channels.filter(l_freq=l_freq, h_freq=h_freq)
+            data[block] = channels._data
+            info = channels.info
+        return info
+
     def _upsample_data(self):
         """
         Upsamples the raw EEG data.
@@ -786,8 +1584,11 @@ class CorrectionFramework:
         Returns:
             None
         """
-        self._eeg.mne_raw._data = np.nan_to_num(
-            self._eeg.mne_raw._data, nan=np.nanmean(self._eeg.mne_raw._data)
+        # in place, so memory-mapped data stays in its file
+        np.nan_to_num(
+            self._eeg.mne_raw._data,
+            copy=False,
+            nan=np.nanmean(self._eeg.mne_raw._data),
         )
 
     def resample_data(self, sfreq):
@@ -798,17 +1599,34 @@ class CorrectionFramework:
             sfreq (float): The target sampling frequency.
         """
         sfreq_old = self._eeg.mne_raw.info["sfreq"]
-        # TODO: Consider changing estimated_noise to a mne object, to avoid copying
-        noise_raw = self._eeg.mne_raw.copy()
-        self._eeg.mne_raw.resample(sfreq=sfreq)
-        # performant check if the estimated noise is all zeros with any
-        if not np.any(self._eeg.estimated_noise):
-            self._eeg.estimated_noise = np.zeros(self._eeg.mne_raw._data.shape)
+        noise = self._noise()
+        data = self._eeg.mne_raw._data
+        n_samples = data.shape[1]
+        if (data.dtype != np.float64 or isinstance(data, np.memmap)) and len(
+            self._eeg.mne_raw._raw_lengths
+        ) == 1:
+            self._resample_blocks(data, sfreq)
         else:
-            noise_raw._data = self._eeg.estimated_noise
-            self._eeg.estimated_noise = noise_raw.resample(sfreq=sfreq)._data.copy()
-            # unload noise_raw
-            noise_raw = None
+            # the raw object is resampled in place, without a copy
+            self._eeg.mne_raw.resample(sfreq=sfreq)
+            # MNE returns the resampled data in memory and in double precision
+            self._eeg.mne_raw._data = self._eeg.store(self._eeg.mne_raw._data)
+        data = None
+        resampled = self._eeg.new_noise(self._eeg.mne_raw._data.shape)
+        if noise.any():
+            # Only the stored windows of the noise are resampled, one span at a time,
+            # with a second of zeros on both sides that keeps the edges of the resampling
+            # away from them. Every span is resampled onto the samples of the data, as
+            # MNE resamples the data with its automatic padding.
+            geometry = self._resample_geometry(n_samples, sfreq / sfreq_old)
+            for start, stop in noise.spans(int(sfreq_old)):
+                resampled.add_block(
+                    noise.channels,
+                    *self._resample_span(
+                        noise.rows(noise.channels, start, stop), start, geometry
+                    ),
+                )
+        self._eeg.estimated_noise = resampled
         if self._eeg.loaded_triggers is None:
             return
         # update the trigger positions
@@ -818,6 +1636,111 @@ class CorrectionFramework:
 
         self._facet._analysis.derive_parameters()
 
+    def _resample_geometry(self, n_samples, ratio):
+        """
+        Returns the geometry of resampling a signal with the automatic padding of MNE.
+
+        MNE pads the signal to a power of two and resamples the padded signal, so the
+        resampled samples are spaced by the ratio of the padded lengths, which differs
+        slightly from the ratio of the sampling frequencies.
+
+        Parameters:
+            n_samples (int): The number of samples of the signal.
+            ratio (float): The ratio of the new to the old sampling frequency.
+
+        Returns:
+            tuple: The padding before the signal, the padded length, the resampled padded
+            length and the number of resampled samples removed before the signal.
+        """
+        min_add = min(n_samples // 8, 100) * 2
+        padded = 2 ** int(np.ceil(np.log2(n_samples + min_add)))
+        before = (padded - n_samples) // 2
+        return (
+            before,
+            padded,
+            max(int(round(ratio * padded)), 1),
+            int(round(ratio * before)),
+        )
+
+    def _resample_span(self, block, start, geometry):
+        """
+        Resamples a span of a signal onto the resampled samples of the whole signal.
+
+        The span is taken as one period of a band-limited signal, cut off where the
+        resampling of the whole signal cuts off, which is evaluated at the resampled
+        samples within the span with a chirp z-transform. Unlike resampling the span on
+        its own, this keeps the spacing of the resampled samples of the whole signal,
+        whatever the ratio of the lengths. The span must end in zeros on both sides.
+
+        Parameters:
+            block (numpy.ndarray): The span, (channels x samples).
+            start (int): The first sample of the span in the signal.
+            geometry (tuple): The geometry of resampling the signal, see _resample_geometry.
+
+        Returns:
+            tuple: The first resampled sample within the span and the resampled span.
+        """
+        before, padded, resampled, removed = geometry
+        length = block.shape[1]
+        first = -(-(start + before) * resampled // padded) - removed
+        step = padded / resampled
+        phase = (first + removed) * step - before - start
+        n_resampled = int(np.ceil((length - phase) / step))
+        if n_resampled <= 0:
+            return first, np.zeros((block.shape[0], 0))
+        n_bins = min(int(length * min(resampled / padded, 1) // 2), length // 2) + 1
+        spectrum = rfft(block.astype(np.float64), axis=1)[:, :n_bins]
+        # the real parts below count every frequency twice, except the zero and the
+        # Nyquist frequency
+        spectrum[:, 0] /= 2
+        if 2 * (n_bins - 1) == length:
+            spectrum[:, -1] /= 2
+        values = czt(
+            spectrum,
+            n_resampled,
+            w=np.exp(2j * np.pi * step / length),
+            a=np.exp(-2j * np.pi * phase / length),
+            axis=1,
+        )
+        return first, 2 * values.real / length
+
+    def _resample_blocks(self, data, sfreq):
+        """
+        Resamples the data of the raw object like raw.resample, one block of channels at a time.
+
+        Every block of channels is resampled as a double precision copy in a raw object
+        of its own and written into a preallocated array in the precision of the data,
+        memory-mapped if the data is. Only one block is held in double precision, which
+        MNE requires, instead of the whole recording.
+
+        Parameters:
+            data (numpy.ndarray): The (channels x samples) data of the raw object.
+            sfreq (float): The target sampling frequency.
+        """
+        raw = self._eeg.mne_raw
+        resampled = None
+        n_block = max(self._batch_bytes // (8 * data.shape[1]), 1)
+        for first in range(0, data.shape[0], n_block):
+            block = np.arange(first, min(first + n_block, data.shape[0]))
+            channels = mne.io.RawArray(
+                data[block].astype(np.float64),
+                mne.pick_info(raw.info, block),
+                first_samp=raw.first_samp,
+                verbose=False,
+            )
+            channels.resample(sfreq=sfreq)
+            if resampled is None:
+                resampled = self._eeg.zeros((data.shape[0], channels.n_times))
+            resampled[block] = channels._data
+        # the same bookkeeping as raw.resample, for a raw object of one segment
+        raw._cropped_samp = int(np.round(raw._cropped_samp * sfreq / raw.info["sfreq"]))
+        raw._first_samps = np.array([channels.first_samp])
+        raw._last_samps = np.array([channels.last_samp])
+        raw._data = resampled
+        with raw.info._unlock():
+            raw.info["lowpass"] = channels.info["lowpass"]
+            raw.info["sfreq"] = channels.info["sfreq"]
+
     def _find_max_cross_correlation(self, base, compare, search_window):
         """
         Finds the maximum cross correlation between two signals.
@@ -835,7 +1758,9 @@ class CorrectionFramework:
         # Calculate the cross correlation
         # Reduce positions to a window of 3 * _eeg.mne_raw.upsampling_factor
 
-        corr = crosscorrelation(base, compare, search_window)
+        corr = crosscorrelation(
+            base, compare, search_window, workspace=self._crosscorr_workspace
+        )
         # Find the maximum of the cross correlation
         max_corr = np.argmax(corr)
         return max_corr
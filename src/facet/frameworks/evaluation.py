@@ -8,33 +8,54 @@ Date: 15.02.2024
 Version: 1.0
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import mne
 import matplotlib.pyplot as plt
 from loguru import logger
+from facet.helpers.utils import epoch_view, epoch_starts
 
 
 class EvaluationFramework:
-    def __init__(self, facet):
+    # Number of samples per channel that are read at once when the moments are calculated
+    _block_samples = 2**16
+    # Upper bound for the epochs of one chunk of the median imaging artifact
+    _batch_bytes = 16 * 1024**2
+
+    def __init__(self, facet, n_jobs=1):
         """
         Initializes the EvaluationFramework class.
 
         Parameters:
             facet (facet class instance): An instance of the facet class.
+            n_jobs (int, optional): Number of threads the datasets are evaluated in. -1 uses all cores.
         """
         self._eeg_eval_dict_list = []
         self._facet = facet
+        self.n_jobs = n_jobs
         return
 
-    def add_to_evaluate(self, eeg, start_time=None, end_time=None, name=None):
+    def add_to_evaluate(
+        self, eeg, start_time=None, end_time=None, name=None, copy=False
+    ):
         """
         Add EEG data to the evaluation list.
 
+        The entry stores references to the data arrays of the EEG object, the evaluated
+        channels, the sample ranges of the evaluated and of the reference data and the
+        epochs around the artifact triggers, the measures read them when evaluate is
+        called. The uncorrected data is shared read-only by all entries that use it.
+        Changes made in place to the data before evaluate is called are evaluated as
+        well, unless a snapshot is stored.
+
         Parameters:
             eeg (facet.eeg_obj): The EEG data to be evaluated.
             start_time (float, optional): Start time of the data to be evaluated.
             end_time (float, optional): End time of the data to be evaluated.
             name (str, optional): Name of the evaluation dataset.
+            copy (bool, optional): Whether to store a snapshot of the EEG object with
+            eeg.copy(), for data that is changed in place afterwards. Defaults to False.
 
         Returns:
             None
@@ -51,24 +72,23 @@ class EvaluationFramework:
                 if eeg.time_first_artifact_start
                 else eeg.data_time_start
             )
+        if copy:
+            eeg = eeg.copy()
         raw = eeg.mne_raw
         logger.debug("Channels that will be evaluated: " + str(raw.ch_names))
 
         eeg_channels = mne.pick_types(
             raw.info, meg=False, eeg=True, stim=False, eog=False, exclude="bads"
         )
-        channels_to_keep = [raw.ch_names[i] for i in eeg_channels[:]]
-        cropped_mne_raw = self._crop(
-            raw=eeg.mne_raw, tmin=start_time, tmax=end_time
-        ).pick(channels_to_keep)
-        ref_mne_raw = self._cutout(
-            raw=eeg.mne_raw, tmin=start_time, tmax=end_time
-        ).pick(channels_to_keep)
+        if eeg.mne_raw_orig._data is not raw._data:
+            eeg.mne_raw_orig._data.flags.writeable = False
         artifact_raw_reference_raw_dict = {
-            "eeg": eeg,
-            "raw": cropped_mne_raw,
-            "ref": ref_mne_raw,
-            "raw_orig": eeg.mne_raw_orig,
+            "data": raw._data,
+            "orig": eeg.mne_raw_orig._data,
+            "channels": eeg_channels,
+            "raw": self._crop(raw=raw, tmin=start_time, tmax=end_time),
+            "ref": self._cutout(raw=raw, tmin=start_time, tmax=end_time),
+            "epochs": self._epochs(eeg, eeg_channels),
             "name": name,
         }
 
@@ -76,9 +96,47 @@ class EvaluationFramework:
 
         return
 
+    def _epochs(self, eeg, picks):
+        """
+        Find the epochs around the artifact triggers of the EEG data, like mne.Epochs.
+
+        Parameters:
+            eeg (facet.eeg_obj): The EEG data.
+            picks (numpy.ndarray): The evaluated channels.
+
+        Returns:
+            dict: The first sample of every epoch and the number of samples per epoch,
+            with what mne.Epochs needs if the data has projections. None without triggers.
+        """
+        if eeg.loaded_triggers is None:
+            return None
+        raw = eeg.mne_raw
+        # Create epochs around the artifact triggers
+        events = np.column_stack(
+            (
+                eeg.loaded_triggers,
+                np.zeros_like(eeg.loaded_triggers),
+                np.ones_like(eeg.loaded_triggers),
+            )
+        )
+        starts, n_samples = epoch_starts(
+            raw, events, eeg.get_tmin(), eeg.get_tmax(), picks=picks
+        )
+        epochs = {"starts": starts, "n_samples": n_samples}
+        if raw.info["projs"]:
+            # MNE applies the projections to the epochs, which the views of the data do not
+            epochs.update(
+                info=raw.info.copy(),
+                first_samp=raw.first_samp,
+                events=events,
+                tmin=eeg.get_tmin(),
+                tmax=eeg.get_tmax(),
+            )
+        return epochs
+
     def _crop(self, raw, tmin, tmax):
         """
-        Crop the raw EEG data to a specified time window.
+        Find the samples of a time window of the raw EEG data, like raw.crop.
 
         Parameters:
             raw (mne.io.Raw): The raw EEG data.
@@ -86,19 +144,19 @@ class EvaluationFramework:
             tmax (float): The end time of the crop window.
 
         Returns:
-            mne.io.Raw: The cropped raw EEG data.
+            list: The slice of the samples in the window.
         """
         # check if tmax is in the data
         if tmax > raw.times[-1]:
             tmax = raw.times[-1]
         # ensure that tmin is smaller than tmax
         if tmin >= tmax:
-            return raw.copy().crop(tmin=0, tmax=0)
-        return raw.copy().crop(tmin=tmin, tmax=tmax)
+            return [slice(0, 1)]
+        return [slice(self._sample(raw, tmin), self._sample(raw, tmax) + 1)]
 
     def _cutout(self, raw, tmin, tmax):
         """
-        Cut out a specified time window from the raw EEG data.
+        Find the samples of the raw EEG data outside of a time window, like cropping before and after it.
 
         Parameters:
             raw (mne.io.Raw): The raw EEG data.
@@ -106,18 +164,113 @@ class EvaluationFramework:
             tmax (float): The end time of the window to cut out.
 
         Returns:
-            mne.io.Raw: The raw EEG data with the specified window removed.
+            list: The slices of the samples before and after the window, each including its boundary sample.
         """
         # check if tmax is in the data
         if tmax > raw.times[-1]:
             tmax = raw.times[-1]
 
-        first_part = raw.copy().crop(tmax=tmin)
+        return [
+            slice(0, self._sample(raw, tmin) + 1),
+            slice(self._sample(raw, tmax), raw.n_times),
+        ]
+
+    def _sample(self, raw, time):
+        """
+        Find the sample nearest to a time, like raw.crop does.
+
+        Parameters:
+            raw (mne.io.Raw): The raw EEG data.
+            time (float): The time relative to the first sample.
+
+        Returns:
+            int: The sample.
+        """
+        return min(max(int(round(time * raw.info["sfreq"])), 0), raw.n_times - 1)
 
-        second_part = raw.copy().crop(tmin=tmax)
+    def _blocks(self, data, rows, windows):
+        """
+        Yield the samples of some rows of the data in windows, block by block.
 
-        first_part.append(second_part)
-        return first_part
+        Parameters:
+            data (numpy.ndarray): The data, (channels x samples).
+            rows (numpy.ndarray): The rows to read.
+            windows (list): The slices of the samples to read.
+
+        Yields:
+            numpy.ndarray: The next block of samples, (rows x at most _block_samples).
+        """
+        for window in windows:
+            for start in range(window.start, window.stop, self._block_samples):
+                yield data[rows, start : min(start + self._block_samples, window.stop)]
+
+    def _moments(self, mnedict, kinds=("raw", "ref", "orig")):
+        """
+        Calculate the per-channel moments of the samples a dataset is evaluated with, in one chunked pass.
+
+        The moments are taken of the evaluated samples ("raw"), the reference samples
+        ("ref") and the samples of the uncorrected data ("orig"), of those of them that
+        are asked for. Only the RMS of the uncorrected to the corrected data needs the
+        uncorrected data, which is otherwise not read at all. The mean and the sum
+        of squared deviations from it are taken of every block and merged into the
+        running ones (Chan et al.), in double precision. Unlike the sum of squares minus
+        the squared mean, this keeps the power exact for channels with a large offset.
+
+        Parameters:
+            mnedict (dict): The evaluation dataset.
+            kinds (tuple, optional): The kinds of samples to take the moments of. Defaults to all.
+
+        Returns:
+            dict: For every kind of samples the number of samples and the per-channel means and sums of squared deviations.
+        """
+        sources = {
+            "raw": (mnedict["data"], mnedict["channels"], mnedict["raw"]),
+            "ref": (mnedict["data"], mnedict["channels"], mnedict["ref"]),
+        }
+        if "orig" in kinds:
+            data_orig = mnedict["orig"]
+            # TODO: Bugfix for different number of channels
+            rows_orig = np.arange(min(len(mnedict["channels"]), data_orig.shape[0]))
+            sources["orig"] = (data_orig, rows_orig, [slice(0, data_orig.shape[1])])
+        moments = {}
+        for key in kinds:
+            data, rows, windows = sources[key]
+            count = 0
+            mean = np.zeros(len(rows))
+            deviations = np.zeros(len(rows))
+            for block in self._blocks(data, rows, windows):
+                block = block.astype(np.float64, copy=False)
+                n_block = block.shape[1]
+                if n_block == 0:
+                    continue
+                mean_block = np.mean(block, axis=1)
+                centred = block - mean_block[:, np.newaxis]
+                delta = mean_block - mean
+                count += n_block
+                mean += delta * (n_block / count)
+                deviations += np.einsum("ij,ij->i", centred, centred)
+                deviations += delta**2 * ((count - n_block) * n_block / count)
+            moments[key] = (count, mean, deviations)
+        return moments
+
+    def _map_datasets(self, func):
+        """
+        Applies a function to every evaluation dataset, spread over a thread pool if n_jobs is not 1.
+
+        The numpy operations release the GIL, so the threads run in parallel.
+
+        Parameters:
+            func (callable): The function to apply.
+
+        Returns:
+            list: The results in the order of the datasets.
+        """
+        items = self._eeg_eval_dict_list
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if n_jobs is None or n_jobs <= 1 or len(items) <= 1:
+            return list(map(func, items))
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(items))) as executor:
+            return list(executor.map(func, items))
 
     def evaluate(self, plot=True, measures=[]):
         """
@@ -131,15 +284,29 @@ class EvaluationFramework:
             list: A list of dictionaries containing the results of the evaluation for each measure.
         """
         results = []
+        moments = None
+        kinds = set()
+        if {"SNR", "RMS2"} & set(measures):
+            kinds |= {"raw", "ref"}
+        if "RMS" in measures:
+            kinds |= {"raw", "orig"}
+        if kinds and self._eeg_eval_dict_list:
+            # one pass over the data of every dataset serves all moment based measures
+            kinds = tuple(kind for kind in ("raw", "ref", "orig") if kind in kinds)
+            moments = self._map_datasets(lambda mnedict: self._moments(mnedict, kinds))
         if "SNR" in measures:
             results.append(
-                {"Measure": "SNR", "Values": self.evaluate_SNR(), "Unit": "dB"}
+                {
+                    "Measure": "SNR",
+                    "Values": self.evaluate_SNR(moments=moments),
+                    "Unit": "dB",
+                }
             )
         if "RMS" in measures:
             results.append(
                 {
                     "Measure": "RMS Uncorrected to Corrected",
-                    "Values": self.evaluate_RMS_corrected_ratio(),
+                    "Values": self.evaluate_RMS_corrected_ratio(moments=moments),
                     "Unit": "Ratio",
                 }
             )
@@ -147,7 +314,7 @@ class EvaluationFramework:
             results.append(
                 {
                     "Measure": "RMS Corrected to Unimpaired",
-                    "Values": self.evaluate_RMS_residual_ratio(),
+                    "Values": self.evaluate_RMS_residual_ratio(moments=moments),
                     "Unit": "Ratio",
                 }
             )
@@ -207,10 +374,13 @@ class EvaluationFramework:
 
         return 0
 
-    def evaluate_RMS_corrected_ratio(self):
+    def evaluate_RMS_corrected_ratio(self, moments=None):
         """
         Calculate the ratio of the Root Mean Square (RMS) values before and after correction.
 
+        Parameters:
+            moments (list, optional): The moments of the datasets from _moments, calculated if not given.
+
         Returns:
             list: A list containing the RMS ratios for each evaluated dataset.
         """
@@ -219,31 +389,29 @@ class EvaluationFramework:
                 "Please set at least one EEG dataset and crop the EEG to evaluate before calculating RMS."
             )
             return
+        if moments is None:
+            moments = self._map_datasets(
+                lambda mnedict: self._moments(mnedict, ("raw", "orig"))
+            )
         results = []
-        for mnedict in self._eeg_eval_dict_list:
-            # Extracting the data
-            data_corrected = mnedict["raw"].get_data()
-            data_uncorrected = mnedict["raw_orig"].get_data()
-
-            # TODO: Bugfix for different number of channels
-            if data_corrected.shape[0] != data_uncorrected.shape[0]:
-                data_uncorrected = data_uncorrected[: data_corrected.shape[0], :]
-
+        for dataset_moments in moments:
             # Calculate RMS
-            rms_corrected = np.sqrt(np.mean(data_corrected**2, axis=1))
-            rms_uncorrected = np.sqrt(np.mean(data_uncorrected**2, axis=1))
+            rms_corrected = self._rms(dataset_moments["raw"])
+            rms_uncorrected = self._rms(dataset_moments["orig"])
 
             # Calculate Ratio
             rms = rms_uncorrected / rms_corrected
-            np.median(rms)
             results.append(np.median(rms))
 
         return results
 
-    def evaluate_RMS_residual_ratio(self):
+    def evaluate_RMS_residual_ratio(self, moments=None):
         """
         Calculate the ratio of the Root Mean Square (RMS) values of the corrected data to the unimpaired reference.
 
+        Parameters:
+            moments (list, optional): The moments of the datasets from _moments, calculated if not given.
+
         Returns:
             list: A list containing the RMS ratios for each evaluated dataset.
         """
@@ -252,94 +420,130 @@ class EvaluationFramework:
                 "Please set at least one EEG dataset and crop the EEG to evaluate before calculating RMS."
             )
             return
+        if moments is None:
+            moments = self._map_datasets(
+                lambda mnedict: self._moments(mnedict, ("raw", "ref"))
+            )
         results = []
-        for mnedict in self._eeg_eval_dict_list:
-            # Extracting the data
-            data_corrected = mnedict["raw"].get_data()
-            data_ref = mnedict["ref"].get_data()
-
+        for dataset_moments in moments:
             # Calculate RMS
-            rms_corrected = np.sqrt(np.mean(data_corrected**2, axis=1))
-            rms_ref = np.sqrt(np.mean(data_ref**2, axis=1))
+            rms_corrected = self._rms(dataset_moments["raw"])
+            rms_ref = self._rms(dataset_moments["ref"])
 
             # Calculate Ratio
             rms = rms_corrected / rms_ref
-            np.median(rms)
             results.append(np.median(rms))
 
         return results
 
-    def calculate_median_imaging_artifact(self):
+    def _rms(self, moments):
+        """
+        Calculate the per-channel Root Mean Square (RMS) from the moments of samples.
+
+        Parameters:
+            moments (tuple): The number of samples and the per-channel means and sums of squared deviations.
+
+        Returns:
+            numpy.ndarray: The RMS of every channel.
+        """
+        count, mean, deviations = moments
+        return np.sqrt(deviations / count + mean**2)
+
+    def _power(self, moments):
+        """
+        Calculate the per-channel power, the variance, from the moments of samples.
+
+        Parameters:
+            moments (tuple): The number of samples and the per-channel means and sums of squared deviations.
+
+        Returns:
+            numpy.ndarray: The power of every channel.
+        """
+        count, _, deviations = moments
+        return deviations / count
+
+    def calculate_median_imaging_artifact(self, chunked=True):
         """
         Calculate the median imaging artifact value for each evaluated EEG dataset.
 
+        Parameters:
+            chunked (bool, optional): Whether the epochs are reduced in chunks of at most _batch_bytes,
+            which bounds the memory for long recordings, instead of all at once. Defaults to True.
+
         Returns:
-            list: A list containing the median imaging artifact values for each dataset.
+            list: A list containing the median imaging artifact values for each dataset, NaN for a dataset without triggers.
         """
         if not hasattr(self, "_eeg_eval_dict_list") or not self._eeg_eval_dict_list:
             logger.error("eeg_list is not set or empty.")
             return
 
-        results = []
+        return self._map_datasets(
+            lambda mne_dict: self._median_imaging_artifact(mne_dict, chunked)
+        )
 
-        for mne_dict in self._eeg_eval_dict_list:
-            _eeg = mne_dict["eeg"]
-            if _eeg.mne_raw is None:
-                logger.error("EEG dataset is not set for this mne_dict.")
-                continue
-
-            # Create epochs around the artifact triggers
-            events = np.column_stack(
-                (
-                    _eeg.loaded_triggers,
-                    np.zeros_like(_eeg.loaded_triggers),
-                    np.ones_like(_eeg.loaded_triggers),
-                )
-            )
-            tmin = _eeg.get_tmin()  # Start time before the event
-            tmax = _eeg.get_tmax()  # End time after the event
-            baseline = None  # No baseline correction
-            picks = mne.pick_types(
-                _eeg.mne_raw.info,
-                meg=False,
-                eeg=True,
-                stim=False,
-                eog=False,
-                exclude="bads",
-            )
+    def _median_imaging_artifact(self, mne_dict, chunked=True):
+        """
+        Calculate the median imaging artifact value of an evaluated EEG dataset.
+
+        The peak-to-peak values are taken over epoch views of every EEG channel around the
+        artifact triggers, the same epochs mne.Epochs creates, in one vectorized reduction
+        per channel and chunk of epochs. Only the rows of the EEG channels are read.
 
+        Parameters:
+            mne_dict (dict): The evaluation dataset.
+            chunked (bool, optional): Whether the epochs are reduced in chunks of at most _batch_bytes.
+
+        Returns:
+            float: The median imaging artifact value, NaN if the dataset has no triggers.
+        """
+        epochs = mne_dict["epochs"]
+        if epochs is None:
+            logger.error("The EEG dataset has no triggers to take epochs around.")
+            return np.nan
+
+        data, picks = mne_dict["data"], mne_dict["channels"]
+        if "info" in epochs:
+            raw = mne.io.RawArray(
+                data, epochs["info"], first_samp=epochs["first_samp"], verbose=False
+            )
             epochs = mne.Epochs(
-                _eeg.mne_raw,
-                events=events,
-                tmin=tmin,
-                tmax=tmax,
+                raw,
+                events=epochs["events"],
+                tmin=epochs["tmin"],
+                tmax=epochs["tmax"],
                 proj=True,
                 reject=None,
                 picks=picks,
-                baseline=baseline,
+                baseline=None,
                 preload=True,
             )
-            # Calculate the peak-to-peak value for each epoch and channel
-            p2p_values_per_epoch = [
-                np.ptp(epoch, axis=1) for epoch in epochs.get_data()
-            ]
-
-            # Calculate the mean peak-to-peak value per epoch across all channels
-            mean_p2p_per_epoch = [
-                np.mean(epoch_p2p) for epoch_p2p in p2p_values_per_epoch
-            ]
-
-            # Calculate the median of these mean values
-            vmed = np.median(mean_p2p_per_epoch)
-
-            results.append(vmed)
-
-        return results
-
-    def evaluate_SNR(self):
+            p2p_values = np.ptp(epochs.get_data(), axis=-1)
+            return np.median(np.mean(p2p_values, axis=1))
+
+        starts, n_samples = epochs["starts"], epochs["n_samples"]
+        epoch_bytes = n_samples * data.itemsize
+        chunk = max(self._batch_bytes // epoch_bytes if chunked else len(starts), 1)
+        p2p_sum_per_epoch = np.zeros(len(starts))
+        for pick in picks:
+            for low in range(0, len(starts), chunk):
+                high = min(low + chunk, len(starts))
+                # (epochs x samples), a view of the channel for regular triggers
+                epochs = epoch_view(data[pick], starts[low:high], n_samples)
+                # Calculate the peak-to-peak value for each epoch
+                p2p_sum_per_epoch[low:high] += np.ptp(epochs, axis=-1)
+        # Calculate the mean peak-to-peak value per epoch across all channels
+        mean_p2p_per_epoch = p2p_sum_per_epoch / len(picks)
+
+        # Calculate the median of these mean values
+        return np.median(mean_p2p_per_epoch)
+
+    def evaluate_SNR(self, moments=None):
         """
         Calculate the Signal-to-Noise Ratio (SNR) for each evaluated EEG dataset.
 
+        Parameters:
+            moments (list, optional): The moments of the datasets from _moments, calculated if not given.
+
         Returns:
             list: A list containing the SNR values for each dataset.
         """
@@ -348,15 +552,15 @@ class EvaluationFramework:
                 "Please set both EEG datasets and crop the EEG to evaluate before calculating SNR."
             )
             return
+        if moments is None:
+            moments = self._map_datasets(
+                lambda mnedict: self._moments(mnedict, ("raw", "ref"))
+            )
         results = []
-        for mnedict in self._eeg_eval_dict_list:
-            # Extracting the data
-            data_to_evaluate = mnedict["raw"].get_data()
-            data_reference = mnedict["ref"].get_data()
-
+        for dataset_moments in moments:
             # Calculate power of the signal
-            power_corrected = np.var(data_to_evaluate, axis=1)
-            power_without = np.var(data_reference, axis=1)
+            power_corrected = self._power(dataset_moments["raw"])
+            power_without = self._power(dataset_moments["ref"])
 
             # Calculate power of the residual (noise)
             power_residual = power_corrected - power_without
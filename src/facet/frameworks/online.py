@@ -0,0 +1,363 @@
+"""
+Online correction framework Module
+
+This module contains the OnlineCorrectionFramework class, which corrects gradient artifacts
+in EEG data while it is recorded.
+
+Author: Janik Michael Müller
+Date: 15.02.2024
+Version: 1.0
+"""
+
+import time
+from collections import deque
+import numpy as np
+import mne
+from loguru import logger
+
+
+class OnlineCorrectionFramework:
+    """
+    The OnlineCorrectionFramework class removes gradient artifacts from a stream of EEG samples.
+
+    The samples arrive in blocks of any size. Every trigger announces an artifact window that
+    starts at tmin and ends at tmax relative to it. As soon as the last sample of a window has
+    arrived, the window is stored in a ring buffer of the last window_size epochs of every
+    corrected channel. The running AAS template of the earlier epochs is subtracted from the
+    window, then the template is updated: the new epoch is added to the average if it
+    correlates with the template above the threshold, and the epoch that drops out of the
+    ring buffer is removed from it. Samples are returned once no announced or future artifact window can change
+    them any more, so the latency is bounded by the artifact length, the part of the window
+    before the trigger and the block size.
+
+    The samples that were not returned yet are kept in a preallocated ring buffer, which
+    only grows when a block does not fit, so every push costs time in proportion to its
+    block and not to the stream. Only the channels in picks are corrected, the other
+    channels, e.g. stimulus, EOG and bad channels, are returned unchanged.
+
+    Unlike calc_matrix_aas, the template of an artifact only averages the artifacts before
+    it, so the first artifact is not corrected, the channel means are the means of the
+    samples received so far, and the triggers are not realigned. The artifact windows have
+    the length of the epochs of calc_matrix_aas.
+
+    Attributes:
+        n_channels (int): Number of channels in every block.
+        picks (numpy.ndarray): The channels that are corrected.
+        sfreq (float): The sampling frequency of the stream.
+        window_size (int): Number of recent epochs the template is averaged over.
+        threshold (float): Correlation with the template above which an epoch is averaged.
+        n_samples_in (int): Number of samples received per channel.
+        n_samples_out (int): Number of corrected samples returned per channel.
+        n_artifacts (int): Number of artifacts corrected.
+        processing_time (float): Seconds spent in push and flush.
+        max_latency (int): Largest number of samples held back after a push.
+    """
+
+    def __init__(
+        self,
+        n_channels,
+        sfreq,
+        tmin,
+        tmax,
+        window_size=30,
+        threshold=0.975,
+        n_reference=5,
+        picks=None,
+    ):
+        """
+        Initializes the OnlineCorrectionFramework class.
+
+        Parameters:
+            n_channels (int): Number of channels in every block.
+            sfreq (float): The sampling frequency of the stream.
+            tmin (float): Start of the artifact relative to its trigger in seconds.
+            tmax (float): End of the artifact relative to its trigger in seconds.
+            window_size (int, optional): Number of recent epochs the template is averaged over. Defaults to 30.
+            threshold (float, optional): Correlation with the template above which an epoch is averaged. Defaults to 0.975.
+            n_reference (int, optional): Epochs are averaged without the correlation check while the template
+            averages fewer than this many epochs. Defaults to 5.
+            picks (list, optional): The channels that are corrected. If None, all channels are corrected.
+        """
+        self.n_channels = n_channels
+        self.picks = np.arange(n_channels) if picks is None else np.asarray(picks)
+        self.sfreq = sfreq
+        self.window_size = window_size
+        self.threshold = threshold
+        self.n_reference = n_reference
+        self._smin = int(round(tmin * sfreq))
+        # the last sample at tmax is part of the window, like in epoch_starts
+        self._length = int(round(tmax * sfreq)) + 1 - self._smin
+        # samples that a trigger announced later may still reach back into
+        self._hold = max(-self._smin, 0)
+        n_picks = len(self.picks)
+
+        # ring buffers of the raw samples that were not returned yet and of the artifacts
+        # to subtract from them, stream sample s is stored in column s % capacity
+        capacity = 2 * (self._hold + self._length) + 1024
+        self._buffer = np.zeros((n_channels, capacity))
+        self._correction = np.zeros((n_picks, capacity))
+        self._buffer_start = 0
+        self._sample_sum = np.zeros(n_picks)
+        self._pending = deque()
+
+        # ring buffer of the last epochs and the running sum of the averaged ones
+        self._epochs = np.zeros((window_size, n_picks, self._length))
+        self._averaged = np.zeros((window_size, n_picks), dtype=bool)
+        self._slot = 0
+        self._n_stored = 0
+        self._sum = np.zeros((n_picks, self._length))
+        self._count = np.zeros(n_picks)
+
+        self.n_samples_in = 0
+        self.n_samples_out = 0
+        self.n_artifacts = 0
+        self.processing_time = 0.0
+        self.max_latency = 0
+
+    @classmethod
+    def from_eeg(cls, eeg, window_size=30, threshold=0.975):
+        """
+        Creates an online corrector with the sampling rate, the artifact window and the channels of an EEG object.
+
+        The blocks carry all channels of the EEG object, of which only the EEG channels
+        that are not marked as bad are corrected, like in the CorrectionFramework.
+
+        Parameters:
+            eeg (facet.eeg_obj): The EEG object the artifact window and the channels are taken from.
+            window_size (int, optional): Number of recent epochs the template is averaged over. Defaults to 30.
+            threshold (float, optional): Correlation with the template above which an epoch is averaged. Defaults to 0.975.
+
+        Returns:
+            OnlineCorrectionFramework: The online corrector.
+        """
+        info = eeg.mne_raw.info
+        return cls(
+            len(info.ch_names),
+            info["sfreq"],
+            eeg.get_tmin(),
+            eeg.get_tmax(),
+            window_size=window_size,
+            threshold=threshold,
+            picks=mne.pick_types(
+                info, meg=False, eeg=True, stim=False, eog=False, exclude="bads"
+            ),
+        )
+
+    def push(self, samples, triggers=()):
+        """
+        Adds a block of samples and returns the samples that are corrected completely.
+
+        Parameters:
+            samples (numpy.ndarray): The new samples, (channels x samples).
+            triggers (list, optional): The trigger positions within the block.
+
+        Returns:
+            numpy.ndarray: The corrected samples that follow the previously returned ones, (channels x samples).
+        """
+        begin = time.perf_counter()
+        samples = np.asarray(samples, dtype=float).reshape(self.n_channels, -1)
+        block_start = self.n_samples_in
+        block_stop = block_start + samples.shape[1]
+        self._reserve(block_stop - self._buffer_start)
+        offset = 0
+        for columns in self._columns(block_start, block_stop):
+            width = columns.stop - columns.start
+            self._buffer[:, columns] = samples[:, offset : offset + width]
+            offset += width
+        self._sample_sum += np.sum(samples[self.picks], axis=1)
+        self.n_samples_in = block_stop
+
+        for trigger in sorted(int(trigger) for trigger in triggers):
+            start = block_start + trigger + self._smin
+            if start < self._buffer_start:
+                logger.warning(
+                    f"Skipping trigger at sample {block_start + trigger}, its artifact starts before the returned samples"
+                )
+                continue
+            self._pending.append(start)
+        while self._pending and self._pending[0] + self._length <= self.n_samples_in:
+            self._subtract(self._pending.popleft())
+
+        stop = self.n_samples_in - self._hold
+        if self._pending:
+            stop = min(stop, self._pending[0])
+        corrected = self._release(stop)
+        self.max_latency = max(self.max_latency, self.n_samples_in - self._buffer_start)
+        self.processing_time += time.perf_counter() - begin
+        return corrected
+
+    def flush(self):
+        """
+        Returns all samples that were held back, at the end of the stream.
+
+        Artifacts whose window has not arrived completely are corrected with the current
+        template where samples exist.
+
+        Returns:
+            numpy.ndarray: The remaining corrected samples, (channels x samples).
+        """
+        begin = time.perf_counter()
+        while self._pending:
+            start = self._pending.popleft()
+            available = max(min(self._length, self.n_samples_in - start), 0)
+            template = self._sum / np.maximum(self._count, 1)[:, np.newaxis]
+            self._add_correction(start, template[:, :available])
+        corrected = self._release(self.n_samples_in)
+        self.processing_time += time.perf_counter() - begin
+        return corrected
+
+    @property
+    def stats(self):
+        """
+        Returns the latency and throughput counters.
+
+        Returns:
+            dict: The samples received and returned per channel, the corrected artifacts, the
+            largest latency in seconds, the processing time in seconds, the channel samples
+            processed per second, and the real-time factor, the duration of the received data
+            divided by the processing time. A real-time factor above 1 keeps up with the stream.
+        """
+        duration = self.n_samples_in / self.sfreq
+        with np.errstate(divide="ignore"):
+            throughput = np.divide(
+                self.n_samples_in * self.n_channels, self.processing_time
+            )
+            realtime_factor = np.divide(duration, self.processing_time)
+        return {
+            "samples_in": self.n_samples_in,
+            "samples_out": self.n_samples_out,
+            "artifacts": self.n_artifacts,
+            "max_latency": self.max_latency / self.sfreq,
+            "processing_time": self.processing_time,
+            "throughput": float(throughput),
+            "realtime_factor": float(realtime_factor),
+        }
+
+    def _columns(self, start, stop):
+        """
+        Returns the ring buffer columns of the stream samples from start to stop.
+
+        Parameters:
+            start (int): The first sample in the stream.
+            stop (int): The end of the samples in the stream, at most one capacity after start.
+
+        Returns:
+            list: One or, where the samples wrap around, two slices of ring buffer columns.
+        """
+        capacity = self._buffer.shape[1]
+        first = start % capacity
+        if first + stop - start <= capacity:
+            return [slice(first, first + stop - start)]
+        return [slice(first, capacity), slice(0, first + stop - start - capacity)]
+
+    def _read(self, ring, start, stop):
+        """
+        Returns the stream samples from start to stop of a ring buffer.
+
+        Parameters:
+            ring (numpy.ndarray): The ring buffer, (channels x capacity).
+            start (int): The first sample in the stream.
+            stop (int): The end of the samples in the stream.
+
+        Returns:
+            numpy.ndarray: The samples, (channels x samples).
+        """
+        return np.concatenate(
+            [ring[:, columns] for columns in self._columns(start, stop)], axis=1
+        )
+
+    def _add_correction(self, start, values):
+        """
+        Adds artifact values to the correction of the stream samples from start on.
+
+        Parameters:
+            start (int): The first sample in the stream.
+            values (numpy.ndarray): The values, (picks x samples).
+        """
+        offset = 0
+        for columns in self._columns(start, start + values.shape[1]):
+            width = columns.stop - columns.start
+            self._correction[:, columns] += values[:, offset : offset + width]
+            offset += width
+
+    def _reserve(self, n_samples):
+        """
+        Grows the ring buffers, if needed, to hold a number of samples that were not returned yet.
+
+        The capacity is at least doubled, so growing stays cheap over a stream.
+
+        Parameters:
+            n_samples (int): The number of samples the ring buffers have to hold.
+        """
+        capacity = self._buffer.shape[1]
+        if n_samples <= capacity:
+            return
+        held = (self._buffer_start, self.n_samples_in)
+        buffer = self._read(self._buffer, *held)
+        correction = self._read(self._correction, *held)
+        capacity = max(2 * capacity, n_samples)
+        self._buffer = np.zeros((self.n_channels, capacity))
+        self._correction = np.zeros((len(self.picks), capacity))
+        offset = 0
+        for columns in self._columns(*held):
+            width = columns.stop - columns.start
+            self._buffer[:, columns] = buffer[:, offset : offset + width]
+            self._correction[:, columns] = correction[:, offset : offset + width]
+            offset += width
+
+    def _subtract(self, start):
+        """
+        Subtracts the template from the completed artifact at start and updates the template with it.
+
+        Parameters:
+            start (int): The first sample of the artifact in the stream.
+        """
+        mean = self._sample_sum / self.n_samples_in
+        epoch = (
+            self._read(self._buffer, start, start + self._length)[self.picks]
+            - mean[:, np.newaxis]
+        )
+
+        if self._n_stored == self.window_size:
+            # the oldest epoch leaves the ring buffer and the average
+            averaged = self._averaged[self._slot]
+            self._sum[averaged] -= self._epochs[self._slot][averaged]
+            self._count -= averaged
+        template = self._sum / np.maximum(self._count, 1)[:, np.newaxis]
+        centered_epoch = epoch - np.mean(epoch, axis=1, keepdims=True)
+        centered_template = template - np.mean(template, axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = np.sum(centered_epoch * centered_template, axis=1) / (
+                np.linalg.norm(centered_epoch, axis=1)
+                * np.linalg.norm(centered_template, axis=1)
+            )
+        averaged = (self._count < self.n_reference) | (corr > self.threshold)
+
+        # the template of the earlier epochs, without the epoch it is subtracted from
+        self._add_correction(start, template)
+        self._epochs[self._slot] = epoch
+        self._averaged[self._slot] = averaged
+        self._sum[averaged] += epoch[averaged]
+        self._count += averaged
+        self._slot = (self._slot + 1) % self.window_size
+        self._n_stored = min(self._n_stored + 1, self.window_size)
+        self.n_artifacts += 1
+
+    def _release(self, stop):
+        """
+        Returns the corrected samples before stop and removes them from the ring buffers.
+
+        Parameters:
+            stop (int): The first sample in the stream that is held back.
+
+        Returns:
+            numpy.ndarray: The corrected samples, (channels x samples).
+        """
+        stop = max(stop, self._buffer_start)
+        corrected = self._read(self._buffer, self._buffer_start, stop)
+        corrected[self.picks] -= self._read(self._correction, self._buffer_start, stop)
+        for columns in self._columns(self._buffer_start, stop):
+            self._correction[:, columns] = 0
+        self.n_samples_out += stop - self._buffer_start
+        self._buffer_start = stop
+        return corrected
@@ -1,8 +1,9 @@
 import numpy as np
+from facet.helpers.utils import split_vector
 
 
 class YourClass:
-    # Assuming the presence of required attributes and methods like SplitVector, ProfileStart, and ProfileStop
+    # Assuming the presence of required attributes and methods like ProfileStart and ProfileStop
     def AlignSubSample(self):
         # maximum distance between triggers
         MaxTrigDist = np.max(np.diff(self.TriggersUp))
@@ -36,7 +37,7 @@ class YourClass:
                 HPEEG = self.RAEEGAcq
 
             # Split vector into 2D matrix
-            EEGMatrix = self.SplitVector(
+            EEGMatrix = split_vector(
                 HPEEG, self.TriggersUp - self.PreTrig - 10, NumSamples
             )
             EEG_Ref = EEGMatrix[self.AlignSlicesReference, :]
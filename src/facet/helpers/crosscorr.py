@@ -1,37 +1,169 @@
 import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
 
+# Up to this maxlag the lagged dot products are computed directly with method="auto"
+DIRECT_MAXLAG = 8
 
-def crosscorrelation(x, y, maxlag, mode="corr"):
+
+class CrossCorrelationWorkspace:
+    """
+    Reusable buffers for repeated calls of crosscorrelation.
+
+    Keeps the zero padded input buffer, the spectrum and sums of the last `y`, and the
+    buffers of the product of the spectra, of the lagged dot products and of the
+    correlations, so correlating many signals with the same template only transforms the
+    template once and the buffers are only allocated when the lengths change. The
+    transforms themselves still return new arrays, scipy.fft has no out argument.
+    """
+
+    def __init__(self):
+        self._buffer = None
+        self._y = None
+        self._y_spectrum = None
+        self._y_sums = None
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        """
+        Returns the reused buffer of a name, allocated anew if its shape or dtype changed.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def padded(self, x, nfft):
+        """
+        Returns `x` zero padded to length nfft in the reused buffer.
+        """
+        if (
+            self._buffer is None
+            or len(self._buffer) != nfft
+            or self._buffer.dtype != x.dtype
+        ):
+            self._buffer = np.empty(nfft, dtype=x.dtype)
+        self._buffer[: len(x)] = x
+        self._buffer[len(x) :] = 0
+        return self._buffer
+
+    def template(self, y, nfft):
+        """
+        Returns the conjugate spectrum of length nfft and the sum and sum of squares of `y`.
+        """
+        if (
+            self._y_spectrum is None
+            or (len(self._y_spectrum) - 1) * 2 != nfft
+            or not np.array_equal(self._y, y)
+        ):
+            self._y = np.array(y, copy=True)
+            self._y_spectrum = np.conj(rfft(y, nfft))
+            self._y_sums = _sums(y)
+        return self._y_spectrum, self._y_sums
+
+
+def crosscorrelation(x, y, maxlag, mode="corr", method="auto", workspace=None):
     """
     Cross correlation with a maximum number of lags.
 
-    `x` and `y` must be one-dimensional numpy arrays with the same length.
+    `x` and `y` must be one-dimensional real numpy arrays. The shorter one is zero padded
+    at the end, so that both have the same length.
 
     This computes the same result as
         numpy.correlate(x, y, mode='full')[len(a)-maxlag-1:len(a)+maxlag]
 
+    The lagged dot products are computed with an FFT in O(n log n) (method="fft") or with
+    one dot product per lag (method="direct"). method="auto" uses the direct method if
+    maxlag is at most DIRECT_MAXLAG. A CrossCorrelationWorkspace can be passed to reuse
+    the buffers and the spectrum of `y` across calls. The FFT method then returns a
+    buffer of the workspace, which the next call with the workspace overwrites.
+
+    float32 signals are transformed in single precision, the sums of the Pearson
+    correlation are taken in double precision.
+
     The return vaue has length 2*maxlag + 1.
     """
-    # ensure that x an y are the same length
-    len_diff = len(x) - len(y)
-
-    if len_diff > 0:
-        # x ist länger, also polstere y nur am Ende auf
-        y = np.pad(y, (0, len_diff), mode="constant")
-    elif len_diff < 0:
-        # y ist länger, also polstere x nur am Ende auf
-        x = np.pad(x, (0, abs(len_diff)), mode="constant")
-
-    py = np.pad(y.conj(), 2 * maxlag, mode="constant")
-    T = np.lib.stride_tricks.as_strided(
-        py[2 * maxlag :],
-        shape=(2 * maxlag + 1, len(y) + 2 * maxlag),
-        strides=(-py.strides[0], py.strides[0]),
-    )
-    px = np.pad(x, maxlag, mode="constant")
+    n = max(len(x), len(y))
+    if method == "direct" or (method == "auto" and maxlag <= DIRECT_MAXLAG):
+        dot = np.empty(2 * maxlag + 1)
+        for key, lag in enumerate(range(-maxlag, maxlag + 1)):
+            # sum over m of y[m] * x[m + lag], samples outside of x are zero
+            start = max(0, -lag)
+            stop = min(len(y), len(x) - lag)
+            dot[key] = (
+                np.dot(y[start:stop], x[start + lag : stop + lag])
+                if stop > start
+                else 0
+            )
+        y_sums = _sums(y)
+    else:
+        if workspace is None:
+            workspace = CrossCorrelationWorkspace()
+        # large enough that negative and positive lags do not wrap around
+        nfft = next_fast_len(n + maxlag, real=True)
+        y_spectrum, y_sums = workspace.template(y, nfft)
+        spectrum = rfft(workspace.padded(x, nfft), overwrite_x=True)
+        product = workspace.buffer("product", spectrum.shape, spectrum.dtype)
+        np.multiply(spectrum, y_spectrum, out=product)
+        full = irfft(product, nfft, overwrite_x=True)
+        dot = workspace.buffer("dot", (2 * maxlag + 1,), full.dtype)
+        np.concatenate((full[nfft - maxlag :], full[: maxlag + 1]), out=dot)
+        if mode == "corr":
+            out = workspace.buffer("corr", dot.shape, np.float64)
+            return _pearson(dot, *_sums(x), *y_sums, n + 2 * maxlag, out=out)
+    if mode == "dot":  # get lagged dot product
+        return dot
+    elif mode == "corr":  # gets Pearson correlation
+        return _pearson(dot, *_sums(x), *y_sums, n + 2 * maxlag)
+
+
+def crosscorrelation_batched(X, Y, maxlag, mode="corr"):
+    """
+    Cross correlation of every row of `X` with the same row of `Y` with a maximum number of lags.
+
+    `X` and `Y` must be two-dimensional real numpy arrays with the same number of rows.
+    Row `i` of the result equals crosscorrelation(X[i], Y[i], maxlag, mode), but all rows
+    are computed at once with a single batched real FFT.
+
+    Like crosscorrelation, float32 rows are transformed in single precision.
+
+    The return value has the shape (len(X), 2*maxlag + 1).
+    """
+    n = max(X.shape[1], Y.shape[1])
+    # large enough that negative and positive lags do not wrap around
+    nfft = next_fast_len(n + maxlag, real=True)
+    full = irfft(rfft(X, nfft, axis=1) * np.conj(rfft(Y, nfft, axis=1)), nfft, axis=1)
+    dot = np.concatenate((full[:, nfft - maxlag :], full[:, : maxlag + 1]), axis=1)
     if mode == "dot":  # get lagged dot product
-        return T.dot(px)
+        return dot
     elif mode == "corr":  # gets Pearson correlation
-        return (T.dot(px) / px.size - (T.mean(axis=1) * px.mean())) / (
-            np.std(T, axis=1) * np.std(px)
-        )
+        sums = [s[:, np.newaxis] for s in _sums(X, axis=1) + _sums(Y, axis=1)]
+        return _pearson(dot, *sums, n + 2 * maxlag)
+
+
+def _sums(x, axis=None):
+    """
+    Returns the sum and the sum of squares of `x` along an axis, accumulated in double precision.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if axis is None:
+        return (np.sum(x), np.dot(x, x))
+    return (np.sum(x, axis=axis), np.sum(x * x, axis=axis))
+
+
+def _pearson(dot, x_sum, x_sqsum, y_sum, y_sqsum, size, out=None):
+    """
+    Converts lagged dot products of zero padded signals of length size to Pearson correlations.
+
+    Every lag of the padded signals covers all samples of both signals, so the means and
+    standard deviations of the lagged windows are the same for all lags. The correlations
+    are written into `out` if it is given.
+    """
+    mean_x = x_sum / size
+    mean_y = y_sum / size
+    std_x = np.sqrt(np.maximum(x_sqsum / size - mean_x**2, 0))
+    std_y = np.sqrt(np.maximum(y_sqsum / size - mean_y**2, 0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.divide(dot, size, out=out, dtype=np.float64)
+        out -= mean_y * mean_x
+        out /= std_y * std_x
+    return out
@@ -31,4 +31,38 @@ void fastranc(double *refs, double *d, int N, double mu, double *out, double *y,
     }
     
     free(W);
-}
\ No newline at end of file
+}
+
+void fastranc_float(float *refs, float *d, int N, double mu, float *out, float *y, int veclength) {
+    /* Like fastranc on float arrays, the weights and the sums are kept in double */
+    double *W;
+    int i, j;
+    W = (double *)malloc((N+1) * sizeof(double));
+    double temp, sum;
+    
+    for (i = 0; i <= N; i++) {
+        W[i] = 0;
+    }
+    
+    for (i = 0; i < veclength; i++) {
+        if (i < N) { 
+            out[i] = 0; y[i] = 0;
+        } else {
+            sum = 0;
+            
+            for (j = 0; j <= N; j++) {
+                sum += W[j] * refs[i - N + j]; 
+            }
+            
+            y[i] = (float)sum;
+            out[i] = (float)(d[i] - sum);
+            
+            temp = 2 * mu * (d[i] - sum);
+            for (j = 0; j <= N; j++) {
+                W[j] += temp * refs[i - N + j];
+            }
+        }
+    }
+    
+    free(W);
+}
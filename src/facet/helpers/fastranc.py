@@ -1,5 +1,6 @@
 import numpy as np
-from ctypes import CDLL, c_int, c_double, POINTER
+from ctypes import CDLL, c_int, c_double, c_float, POINTER
+from concurrent.futures import ThreadPoolExecutor
 import sys
 from loguru import logger
 
@@ -34,6 +35,21 @@ try:
 except:
     logger.error("File not found! Check your Project Files")
 
+# float variant, missing in libraries built before it was added
+fastranc_float = None
+if fastranc is not None and hasattr(lib, 'fastranc_float'):
+    fastranc_float = lib.fastranc_float
+    fastranc_float.argtypes = [
+        POINTER(c_float),
+        POINTER(c_float),
+        c_int,
+        c_double,
+        POINTER(c_float),
+        POINTER(c_float),
+        c_int,
+    ]
+    fastranc_float.restype = None
+
 
 def fastr_anc(refs_array, d_array, N_value, mu_value):
     # Umwandeln der numpy Arrays in ctypes und Vorbereiten der Ausgabe-Arrays
@@ -57,3 +73,92 @@ def fastr_anc(refs_array, d_array, N_value, mu_value):
     return out_array, y_array
 
 
+def fastr_anc_multichannel(
+    refs_array, d_array, N_value, mu_values, out_array=None, y_array=None, n_jobs=None
+):
+    """
+    Runs fastranc on every row of (channels x samples) arrays, channels in parallel.
+
+    ctypes releases the GIL while the C function runs, so the channels are spread
+    over a thread pool. The rows are handed to the C function as pointers into the
+    arrays, nothing is converted or copied per call, and the results are written
+    into the given output arrays. If both inputs are float32, the float variant of the
+    C function runs on them, which keeps the filter weights and sums in double. With a
+    library that lacks it, every row is converted to float64 on its own instead.
+
+    Parameters:
+        refs_array (numpy.ndarray): The (channels x samples) reference signals.
+        d_array (numpy.ndarray): The (channels x samples) signals to be cleaned.
+        N_value (int): The filter order.
+        mu_values (float or numpy.ndarray): The step size, for all or for every channel.
+        out_array (numpy.ndarray, optional): C-contiguous array of the input dtype for the cleaned signals.
+        y_array (numpy.ndarray, optional): C-contiguous array of the input dtype for the filtered noise.
+        n_jobs (int, optional): Number of threads. Defaults to the number of cores.
+
+    Returns:
+        tuple: The cleaned signals and the filtered noise, both (channels x samples).
+    """
+    single = refs_array.dtype == np.float32 and d_array.dtype == np.float32
+    dtype = np.float32 if single else np.float64
+    refs_array = np.ascontiguousarray(refs_array, dtype=dtype)
+    d_array = np.ascontiguousarray(d_array, dtype=dtype)
+    n_channels, veclength_value = refs_array.shape
+    mu_values = np.broadcast_to(np.asarray(mu_values, dtype=float), (n_channels,))
+    if out_array is None:
+        out_array = np.empty_like(refs_array)
+    if y_array is None:
+        y_array = np.empty_like(refs_array)
+    for array in (out_array, y_array):
+        if (
+            array.shape != refs_array.shape
+            or array.dtype != dtype
+            or not array.flags.c_contiguous
+        ):
+            raise ValueError(
+                "Output arrays must be C-contiguous arrays of the input shape and dtype"
+            )
+
+    def run(ch):
+        if single:
+            run_float(ch)
+            return
+        fastranc(
+            refs_array[ch].ctypes.data_as(POINTER(c_double)),
+            d_array[ch].ctypes.data_as(POINTER(c_double)),
+            N_value,
+            float(mu_values[ch]),
+            out_array[ch].ctypes.data_as(POINTER(c_double)),
+            y_array[ch].ctypes.data_as(POINTER(c_double)),
+            veclength_value,
+        )
+
+    def run_float(ch):
+        if fastranc_float is None:
+            out, y = fastr_anc(
+                refs_array[ch].astype(np.float64),
+                d_array[ch].astype(np.float64),
+                N_value,
+                float(mu_values[ch]),
+            )
+            out_array[ch], y_array[ch] = out, y
+            return
+        fastranc_float(
+            refs_array[ch].ctypes.data_as(POINTER(c_float)),
+            d_array[ch].ctypes.data_as(POINTER(c_float)),
+            N_value,
+            float(mu_values[ch]),
+            out_array[ch].ctypes.data_as(POINTER(c_float)),
+            y_array[ch].ctypes.data_as(POINTER(c_float)),
+            veclength_value,
+        )
+
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs <= 1 or n_channels <= 1:
+        for ch in range(n_channels):
+            run(ch)
+    else:
+        with ThreadPoolExecutor(max_workers=min(n_jobs, n_channels)) as executor:
+            list(executor.map(run, range(n_channels)))
+
+    return out_array, y_array
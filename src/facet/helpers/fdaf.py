@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+# smoothing of the power spectrum of the reference that normalizes the step size
+BETA = 0.9
+
+
+def fdaf_anc(refs_array, d_array, N_value, mu_value):
+    """
+    Adaptive noise cancellation with a frequency-domain block LMS filter (FDAF).
+
+    The filter has the same N + 1 taps and output as fastr_anc, but it is adapted once
+    per block of at least N + 1 samples with overlap-save FFTs of at least 2 * (N + 1)
+    samples instead of once per sample. The gradient is constrained to the first N + 1
+    lags, so the filter stays a linear convolution. In every frequency bin the step
+    size is chosen so that one block update shrinks the error as much as the
+    sample-wise updates of the block would, which keeps the block update stable for
+    narrow-band references. This lowers the cost from O(N) to O(log N) per sample.
+    As the filter only changes once per block, it follows residuals that change from
+    artifact to artifact less closely than the sample-wise LMS.
+
+    Parameters:
+        refs_array (numpy.ndarray): The reference (noise) signal.
+        d_array (numpy.ndarray): The signal to be cleaned.
+        N_value (int): The filter order, the filter has N + 1 taps.
+        mu_value (float): The step size of the LMS update.
+
+    Returns:
+        tuple: The cleaned signal (d - y) and the filtered noise y. Like in fastr_anc,
+        both are zero for the first N samples.
+    """
+    n_taps = N_value + 1
+    n_fft = next_fast_len(2 * n_taps, real=True)
+    block = n_fft - n_taps
+    veclength = len(refs_array)
+    n_blocks = -(-max(veclength - N_value, 0) // block)
+    # the block starting at sample s needs the n_taps samples before it, which are
+    # zero before the first sample
+    refs = np.zeros(n_taps + N_value + n_blocks * block)
+    refs[n_taps : n_taps + veclength] = refs_array
+    d = np.zeros(N_value + n_blocks * block)
+    d[:veclength] = d_array
+
+    y_array = np.zeros(N_value + n_blocks * block)
+    W = np.zeros(n_fft // 2 + 1, dtype=complex)
+    P = None
+    error = np.zeros(n_fft)
+    for start in range(N_value, N_value + n_blocks * block, block):
+        X = rfft(refs[start : start + n_fft])
+        y = irfft(X * W, n_fft)[n_taps:]
+        y_array[start : start + block] = y
+        error[n_taps:] = d[start : start + block] - y
+        power = X.real**2 + X.imag**2
+        P = power if P is None else BETA * P + (1 - BETA) * power
+        # a block update shrinks the error of a frequency bin like `block` LMS updates
+        contraction = 2 * mu_value * block * P / n_fft
+        step = 2 * mu_value * np.ones_like(contraction)
+        fast = contraction > 1e-8
+        step[fast] *= -np.expm1(-contraction[fast]) / contraction[fast]
+        gradient = irfft(step * np.conj(X) * rfft(error), n_fft)[:n_taps]
+        W += rfft(gradient, n_fft)
+
+    y_array = y_array[:veclength]
+    out_array = np.where(np.arange(veclength) < N_value, 0, d_array - y_array)
+    return out_array, y_array
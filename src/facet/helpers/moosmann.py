@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_array, diags_array
 
 # loguru
 from loguru import logger
@@ -46,18 +47,68 @@ def single_motion(transrotdata, p_slomo_threshold, p_trans_rot_scale):
 
 
 def moving_average(n_fmri, window_size):
-    # Erstelle Gewichtungsmatrix
-    weighting_matrix = np.zeros((n_fmri, n_fmri))
-    # Schleifen zur Füllung der Gewichtungsmatrix
-    for i in range(n_fmri):
-        for j in range(window_size // 2 + 1):
-            if i - j >= 0:
-                weighting_matrix[i, i - j] = 1
-            if i + j < n_fmri:
-                weighting_matrix[i, i + j] = 1
+    # Erstelle Gewichtungsmatrix: a band of ones around the diagonal
+    half_width = window_size // 2
+    offsets = np.arange(-half_width, half_width + 1)
+    offsets = offsets[np.abs(offsets) < n_fmri]
+    weighting_matrix = diags_array(
+        [np.ones(n_fmri - abs(offset)) for offset in offsets],
+        offsets=offsets,
+        shape=(n_fmri, n_fmri),
+        format="csr",
+    )
     return weighting_matrix
 
 
+def _nearest_volumes(motion, k, block_bytes=4 * 1024**2):
+    """
+    Selects for every volume the k volumes with the smallest motion weighted distance.
+
+    The distance of volume i to volume j is |i - j| (plus one for i >= j) plus the
+    scaled motion accumulated in between. Volumes with motion are excluded. The
+    distance matrix is built for blocks of rows at once, and argpartition selects the
+    k smallest distances of each row without sorting it. Of volumes with the same
+    distance, the earlier ones are selected first, like a stable sort would.
+
+    Parameters:
+        motion (numpy.ndarray): The motion of every volume.
+        k (int): The number of volumes to select.
+        block_bytes (int): Upper bound for the memory of one block of rows.
+
+    Returns:
+        numpy.ndarray: An (n_fmri x k) array with the indices of the selected volumes.
+    """
+    n_fmri = len(motion)
+    k = min(k, n_fmri)
+    motion_scaling = k / np.min(motion[motion > 0])
+    columns = np.arange(n_fmri)
+    block_size = max(1, block_bytes // (8 * n_fmri))
+    slid_win = np.empty((n_fmri, k), dtype=int)
+    for block_start in range(0, n_fmri, block_size):
+        rows = np.arange(block_start, min(block_start + block_size, n_fmri))[:, None]
+        before = columns < rows
+        distance = np.where(before, rows - columns, columns - rows + 1).astype(float)
+        # the motion before a volume counts negative, the motion after it positive
+        motion_effect = np.cumsum(np.where(before, -motion, motion), axis=1)
+        distance += motion_scaling * motion_effect
+        distance -= np.min(
+            distance, axis=1, keepdims=True, where=motion == 0, initial=np.inf
+        )
+        distance[:, motion > 0] = np.inf
+
+        # ties at the k-th distance are resolved in favour of the earlier volumes
+        kth = np.argpartition(distance, k - 1, axis=1)[:, k - 1 : k]
+        kth_distance = np.take_along_axis(distance, kth, axis=1)
+        chosen = distance < kth_distance
+        n_missing = k - np.count_nonzero(chosen, axis=1)
+        tied_rows, tied_columns = np.nonzero(distance == kth_distance)
+        rank = np.arange(len(tied_rows)) - np.searchsorted(tied_rows, tied_rows)
+        keep = rank < n_missing[tied_rows]
+        chosen[tied_rows[keep], tied_columns[keep]] = True
+        slid_win[rows[:, 0]] = np.nonzero(chosen)[1].reshape(-1, k)
+    return slid_win
+
+
 def calc_weighted_matrix_by_realignment_parameters_file(
     rp_file, n_fmri, k, threshold=5
 ):
@@ -91,35 +142,16 @@ def calc_weighted_matrix_by_realignment_parameters_file(
     )
 
     if np.max(motiondata["both_not_normed"]) > 0:
-        slid_win = np.zeros((n_fmri, k))
-        distance = np.zeros(n_fmri)
-        for jslide in range(n_fmri):
-            distance[:jslide] = np.arange(jslide, 0, -1)
-            distance[jslide:] = np.arange(1, n_fmri - jslide + 1)
-
-            # Integriere Bewegungsdaten in die Gewichtung
-            motion_scaling = k / np.min(
-                motiondata["both_not_normed"][motiondata["both_not_normed"] > 0]
-            )
-            motion_effect = np.cumsum(
-                np.concatenate(
-                    (
-                        -motiondata["both_not_normed"][:jslide],
-                        motiondata["both_not_normed"][jslide:],
-                    )
-                )
-            )
-            distance += motion_scaling * motion_effect
-            distance[motiondata["both_not_normed"] > 0] = np.nan
-
-            distance -= np.nanmin(distance)
-            sort_order = np.argsort(distance)[:k]
-            slid_win[jslide, :] = sort_order
+        slid_win = _nearest_volumes(motiondata["both_not_normed"], k)
 
         # Erstelle Gewichtungsmatrix
-        weighting_matrix = np.zeros((n_fmri, n_fmri))
-        for j in range(n_fmri):
-            weighting_matrix[j, slid_win[j, :].astype(int)] = 1
+        weighting_matrix = csr_array(
+            (
+                np.ones(slid_win.size),
+                (np.repeat(np.arange(n_fmri), slid_win.shape[1]), slid_win.ravel()),
+            ),
+            shape=(n_fmri, n_fmri),
+        )
     else:
         # Ersetze m_moving_average durch eine entsprechende Python-Funktion
         weighting_matrix = moving_average(n_fmri, k)
@@ -1,4 +1,5 @@
 import numpy as np
+import mne
 
 
 def split_vector(V, Marker, SecLength):
@@ -15,8 +16,107 @@ def split_vector(V, Marker, SecLength):
     """
     SecLength = int(SecLength)
     M = np.zeros((len(Marker), SecLength))
-    for i, marker in enumerate(Marker):
-        marker = int(marker)
-        epoch = V[marker : (marker + SecLength)]
-        M[i, : len(epoch)] = epoch
-    return M
+    return epoch_view(V, Marker, SecLength, out=M)
+
+
+def epoch_view(V, Marker, SecLength, writeable=False, out=None):
+    """
+    Returns the sections of a vector starting at the marker positions without a Python loop.
+
+    If all sections lie within the vector and the markers have a constant distance,
+    the result is a strided view of the vector and nothing is copied. The view is
+    read-only unless writeable is True; writing to it writes to the vector. Otherwise
+    the sections are gathered from a sliding window view of the vector into `out`
+    or a new array. Samples of sections that run past the start or the end of the
+    vector are zero.
+
+    Parameters:
+    V (numpy.ndarray): The input vector or a (channels x samples) matrix.
+    Marker (list): List of marker positions.
+    SecLength (int): Length of each section.
+    writeable (bool): Whether a returned view may be written to.
+    out (numpy.ndarray, optional): Array of shape (..., len(Marker), SecLength) the sections are
+    gathered into. Passing it forces a gather and allows to reuse the memory across calls.
+
+    Returns:
+    numpy.ndarray: An array of shape (..., len(Marker), SecLength) containing the sections.
+    """
+    SecLength = int(SecLength)
+    Marker = np.asarray(Marker).astype(int)
+    n_samples = V.shape[-1]
+    shape = V.shape[:-1] + (len(Marker), SecLength)
+    inside = (Marker >= 0) & (Marker + SecLength <= n_samples)
+
+    if out is None:
+        steps = np.diff(Marker)
+        if len(Marker) > 0 and inside.all() and np.all(steps == steps[:1]):
+            step = steps[0] if len(steps) else 0
+            return np.lib.stride_tricks.as_strided(
+                V[..., Marker[0] :],
+                shape=shape,
+                strides=V.strides[:-1] + (step * V.strides[-1], V.strides[-1]),
+                writeable=writeable,
+            )
+        out = np.zeros(shape, dtype=V.dtype)
+
+    if inside.any():
+        windows = np.lib.stride_tricks.sliding_window_view(V, SecLength, axis=-1)
+        if inside.all() and out.dtype == V.dtype:
+            np.take(windows, Marker, axis=-2, out=out)
+        else:
+            out[..., inside, :] = windows[..., Marker[inside], :]
+    # Sections running past the start or the end are filled where data exists
+    for i in np.flatnonzero(~inside):
+        start = max(Marker[i], 0)
+        stop = min(Marker[i] + SecLength, n_samples)
+        out[..., i, :] = 0
+        if start < stop:
+            out[..., i, start - Marker[i] : stop - Marker[i]] = V[..., start:stop]
+    return out
+
+
+def epoch_starts(raw, events, tmin, tmax, picks=None):
+    """
+    Returns the first samples of the epochs mne.Epochs would create around events.
+
+    The epochs can then be read from raw._data with these positions instead of building
+    an mne.Epochs object, which would copy the epochs of all channels. Like MNE, the
+    window is rounded to whole samples, the event samples include raw.first_samp,
+    and epochs that do not lie completely within the data are dropped. If the
+    recording has BAD annotations, the epochs MNE rejects by annotation are dropped
+    as well.
+
+    Parameters:
+    raw (mne.io.Raw): The raw data the epochs are taken from.
+    events (numpy.ndarray): The events, (events x 3) like for mne.Epochs.
+    tmin (float): Start of the epochs relative to the events in seconds.
+    tmax (float): End of the epochs relative to the events in seconds.
+    picks (list, optional): The channels checked for BAD annotations.
+
+    Returns:
+    tuple: The first sample of each kept epoch in raw._data and the number of samples per epoch.
+    """
+    sfreq = raw.info["sfreq"]
+    start_idx = int(round(tmin * sfreq))
+    n_samples = int(round(tmax * sfreq)) + 1 - start_idx
+    starts = (
+        np.round(events[:, 0] + start_idx / sfreq * sfreq).astype(int) - raw.first_samp
+    )
+    if any(
+        description.lower().startswith("bad")
+        for description in raw.annotations.description
+    ):
+        epochs = mne.Epochs(
+            raw,
+            events=events,
+            tmin=tmin,
+            tmax=tmax,
+            baseline=None,
+            reject=None,
+            preload=False,
+            picks=picks,
+        )
+        epochs.drop_bad()
+        return starts[epochs.selection], n_samples
+    inside = (starts >= 0) & (starts + n_samples <= raw.n_times)
+    return starts[inside], n_samples
@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.signal import oaconvolve
+
+
+def fir_zero_phase(x, b, start=0, stop=None, passes=2):
+    """
+    Filters a signal with an FIR filter without phase shift, computing only a window of the output.
+
+    With passes=2 the result equals filtfilt(b, 1, x, padtype="odd") on the window: the
+    forward and the backward pass are combined into one convolution of the odd extended
+    signal with the kernel b * b[::-1]. With passes=1 the result equals
+    fftconvolve(x, b, mode="same") on the window, which is zero-phase for the
+    symmetric filters of firls. Only the window and the len(b) - 1 samples around it
+    are read, and the convolution runs blockwise with overlap-add FFTs.
+
+    Parameters:
+        x (numpy.ndarray): The signal, one channel or (channels x samples).
+        b (numpy.ndarray): The FIR filter weights.
+        start (int): The first sample of the window.
+        stop (int, optional): The end of the window. Defaults to the end of the signal.
+        passes (int): 2 to filter forward and backward like filtfilt, 1 to filter once like fftconvolve.
+
+    Returns:
+        numpy.ndarray: The filtered window, (channels x) (stop - start) samples.
+    """
+    n_samples = x.shape[-1]
+    stop = n_samples if stop is None else stop
+    # float32 signals are filtered in single precision
+    b = np.asarray(b, dtype=np.result_type(x.dtype, np.float32))
+    if passes == 2:
+        kernel = np.convolve(b, b[::-1])
+        before = after = len(b) - 1
+    elif passes == 1:
+        kernel = b
+        before = len(b) - 1 - (len(b) - 1) // 2
+        after = (len(b) - 1) // 2
+    else:
+        raise ValueError("passes must be 1 or 2")
+    if passes == 2 and n_samples <= len(b) - 1:
+        raise ValueError("The signal is too short for the odd extension")
+
+    positions = np.arange(start - before, stop + after)
+    inside = np.clip(positions, 0, n_samples - 1)
+    segment = x[..., inside]
+    if passes == 2:
+        # odd extension: points reflected at the first and the last sample
+        low, high = positions < 0, positions >= n_samples
+        segment[..., low] = 2 * x[..., :1] - x[..., -positions[low]]
+        segment[..., high] = (
+            2 * x[..., -1:] - x[..., 2 * (n_samples - 1) - positions[high]]
+        )
+    else:
+        segment[..., (positions < 0) | (positions >= n_samples)] = 0
+    kernel = kernel.reshape((1,) * (x.ndim - 1) + (-1,))
+    return oaconvolve(segment, kernel, mode="valid", axes=-1)
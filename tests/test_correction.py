@@ -0,0 +1,226 @@
+# Unit Test Class for the correction steps, runs on a synthetic recording
+import gc
+import mne
+import numpy as np
+import pytest
+from facet.eeg_obj import CompactNoise
+from facet.facet import facet
+
+N_CHANNELS = 4
+ARTIFACT_PEAK = 260e-6
+
+
+def make_raw(sfreq=500.0, n_triggers=120, spacing=40, seed=0):
+    """
+    Creates a recording of sine waves with gradient-like artifacts after every trigger.
+
+    The artifacts are shifted by random multiples of a quarter sample, so their alignment
+    on data upsampled by 4 is not a multiple of the upsampling factor.
+    """
+    rng = np.random.default_rng(seed)
+    n_times = 1000 + n_triggers * spacing
+    times = np.arange(n_times) / sfreq
+    data = np.zeros((N_CHANNELS + 1, n_times))
+    for ch in range(N_CHANNELS):
+        data[ch] = 20e-6 * np.sin(2 * np.pi * (3 + ch) * times)
+        data[ch] += 2e-6 * rng.standard_normal(n_times)
+    triggers = 500 + spacing * np.arange(n_triggers)
+    scale = 1 + 0.1 * np.arange(N_CHANNELS)[:, np.newaxis]
+    for trigger, shift in zip(triggers, rng.integers(-6, 7, n_triggers) / 4):
+        phase = np.arange(spacing) - shift
+        artifact = np.sin(phase * 6 * np.pi / spacing)
+        artifact *= np.sin(np.pi * np.clip(phase, 0, spacing) / spacing) ** 2
+        data[:N_CHANNELS, trigger : trigger + spacing] += 200e-6 * scale * artifact
+    data[N_CHANNELS, triggers] = 1
+    info = mne.create_info(
+        [f"EEG{ch}" for ch in range(N_CHANNELS)] + ["STI"],
+        sfreq,
+        ["eeg"] * N_CHANNELS + ["stim"],
+    )
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+@pytest.fixture
+def load(tmp_path, monkeypatch):
+    """
+    Returns a function that imports the synthetic recording into a new facet object.
+
+    The recording is stored as FIF, which the EDF reader is redirected to.
+    """
+    path = tmp_path / "synthetic_raw.fif"
+    make_raw().save(path, verbose=False)
+    monkeypatch.setattr(
+        mne.io,
+        "read_raw_edf",
+        lambda path, preload: mne.io.read_raw_fif(path, preload=preload),
+    )
+
+    def load_facet(**kwargs):
+        f = facet()
+        f.import_eeg(
+            str(path), artifact_to_trigger_offset=-0.004, upsampling_factor=4, **kwargs
+        )
+        return f
+
+    return load_facet
+
+
+class TestCorrection:
+    def test_local_upsampling(self, load):
+        reference = load()
+        reference.upsample()
+        reference.find_triggers(r"\b1\b")
+        reference.get_correction().calc_matrix_aas()
+        reference.remove_artifacts()
+        reference.get_correction().downsample()
+
+        local = load()
+        local.find_triggers(r"\b1\b")
+        local.get_correction().calc_matrix_aas()
+        local.remove_artifacts(local_upsampling=True)
+
+        expected = reference.get_eeg().mne_raw._data[:N_CHANNELS]
+        corrected = local.get_eeg().mne_raw._data[:N_CHANNELS]
+        assert np.max(np.abs(corrected - expected)) < 0.05 * ARTIFACT_PEAK
+        residual = np.std(corrected[:, 1000:-1000])
+        assert residual < 1.05 * np.std(expected[:, 1000:-1000])
+        assert residual < 0.2 * np.std(load().get_eeg().mne_raw._data[:N_CHANNELS])
+
+    @pytest.mark.parametrize("rel_window_position,memmap", [(0, False), (-0.5, True)])
+    def test_remove_artifacts_chunked(
+        self, load, tmp_path, rel_window_position, memmap
+    ):
+        expected = load()
+        expected.find_triggers(r"\b1\b")
+        expected.get_correction().calc_matrix_aas(
+            rel_window_position=rel_window_position, channels=[1, 2]
+        )
+        expected.remove_artifacts(local_upsampling=True)
+
+        chunked = load(memmap_dir=str(tmp_path) if memmap else None)
+        chunked.find_triggers(r"\b1\b")
+        chunked.remove_artifacts_chunked(
+            rel_window_position=rel_window_position, block_size=60, channels=[1, 2]
+        )
+
+        expected_eeg, chunked_eeg = expected.get_eeg(), chunked.get_eeg()
+        tolerance = 1e-6 * ARTIFACT_PEAK
+        assert np.allclose(
+            chunked_eeg.mne_raw._data, expected_eeg.mne_raw._data, atol=tolerance
+        )
+        assert np.allclose(
+            np.asarray(chunked_eeg.estimated_noise),
+            np.asarray(expected_eeg.estimated_noise),
+            atol=tolerance,
+        )
+        assert chunked_eeg.estimated_noise.channels == [1, 2]
+        assert isinstance(chunked_eeg.mne_raw._data, np.memmap) == memmap
+
+    def test_memmap_import(self, load, tmp_path):
+        expected = load()
+        memmapped = load(memmap_dir=str(tmp_path))
+        assert isinstance(memmapped.get_eeg().mne_raw._data, np.memmap)
+        for f in (expected, memmapped):
+            f.highpass(1)
+            f.find_triggers(r"\b1\b")
+            f.get_correction().calc_matrix_aas()
+            f.remove_artifacts(local_upsampling=True)
+
+        data = memmapped.get_eeg().mne_raw._data
+        assert isinstance(data, np.memmap)
+        assert memmapped.get_eeg().mne_raw.info["highpass"] == 1
+        assert np.allclose(
+            data, expected.get_eeg().mne_raw._data, atol=1e-6 * ARTIFACT_PEAK
+        )
+        # the file MNE read the data into is removed once it is no longer mapped
+        del memmapped, data, f
+        gc.collect()
+        assert not list(tmp_path.glob("*.dat"))
+
+    def test_memmap_import_failure(self, load, tmp_path, monkeypatch):
+        def fail(path, preload):
+            raise OSError("unreadable")
+
+        monkeypatch.setattr(mne.io, "read_raw_edf", fail)
+        with pytest.raises(OSError):
+            load(memmap_dir=str(tmp_path))
+        assert not list(tmp_path.glob("*.dat"))
+
+    @pytest.mark.parametrize("memmap", [False, True])
+    def test_single_precision(self, load, tmp_path, memmap):
+        expected = load()
+        single = load(precision="float32", memmap_dir=str(tmp_path) if memmap else None)
+        for f in (expected, single):
+            f.upsample()
+            f.downsample()
+
+        raw, expected_raw = single.get_eeg().mne_raw, expected.get_eeg().mne_raw
+        assert raw._data.dtype == np.float32
+        assert isinstance(raw._data, np.memmap) == memmap
+        assert raw.info["sfreq"] == expected_raw.info["sfreq"]
+        assert raw.n_times == expected_raw.n_times
+        assert np.allclose(raw.times, expected_raw.times)
+        assert np.allclose(raw._data, expected_raw._data, atol=1e-4 * ARTIFACT_PEAK)
+
+    def test_unknown_precision(self, load):
+        with pytest.raises(ValueError):
+            load(precision="float16")
+
+    @pytest.mark.parametrize("sfreq", [50.0, 2000.0])
+    def test_resample_noise(self, load, sfreq):
+        f, rows = load(), load()
+        dense = np.zeros(f.get_eeg().mne_raw._data.shape)
+        # windows that do not start on a sample of the data at 50 Hz
+        dense[[1, 2], 4567:4767] = np.sin(np.arange(200) * 2 * np.pi / 40)
+        dense[1, 1203:1303] = np.sin(np.arange(100) * 2 * np.pi / 50)
+        f.get_eeg().estimated_noise = CompactNoise.from_dense(dense)
+        rows.get_eeg().mne_raw._data[:] = dense
+        f.get_correction().resample_data(sfreq)
+        rows.get_correction().resample_data(sfreq)
+
+        noise = f.get_eeg().estimated_noise
+        expected = rows.get_eeg().mne_raw._data
+        assert noise.channels == [1, 2] and len(noise.starts) == 2
+        assert np.asarray(noise).shape == expected.shape
+        assert np.allclose(np.asarray(noise), expected, atol=1e-3)
+
+    @pytest.mark.parametrize("rel_window_offset", [0, -0.5])
+    def test_calc_chosen_matrices(self, load, rel_window_offset):
+        correction = load().get_correction()
+        rng = np.random.default_rng(1)
+        shape = np.sin(np.linspace(0, 6 * np.pi, 50))
+        # epochs that are copies of one shape, with a noise level varying per epoch
+        levels = rng.uniform(0, 0.4, (6, 100, 1))
+        epochs = shape + levels * rng.standard_normal((6, 100, 50))
+        matrices = correction.calc_chosen_matrices(
+            epochs, window_size=20, rel_window_offset=rel_window_offset
+        )
+        for ch, matrix in enumerate(matrices):
+            expected = np.zeros((100, 100))
+            for idx in range(0, 100, 20):
+                offset_idx = idx + int(20 * rel_window_offset)
+                candidates = np.arange(max(offset_idx, 0), min(offset_idx + 20, 100))
+                chosen = correction.highly_correlated_epochs_with_indices(
+                    epochs[ch], candidates, np.arange(idx, idx + 5)
+                )
+                expected[idx : idx + 20, chosen] = 1 / len(chosen)
+            assert np.allclose(matrix.toarray(), expected)
+            assert 5 < len(matrix[[50]].indices) < 20
+
+    def test_apply_anc_blocks(self, load):
+        results = []
+        for batch_bytes in [None, 1]:
+            f = load()
+            f.get_eeg().mne_raw.info["bads"] = ["EEG1"]
+            f.find_triggers(r"\b1\b")
+            f.get_correction().calc_matrix_aas()
+            f.remove_artifacts(local_upsampling=True)
+            if batch_bytes is not None:
+                # one channel per block
+                f.get_correction()._batch_bytes = batch_bytes
+            before = f.get_eeg().mne_raw._data.copy()
+            f.apply_ANC()
+            results.append(f.get_eeg().mne_raw._data)
+        assert np.array_equal(results[0], results[1])
+        assert np.array_equal(results[0][[1, 4]], before[[1, 4]])
+        assert not np.allclose(results[0][[0, 2, 3]], before[[0, 2, 3]])
@@ -0,0 +1,185 @@
+# Unit Test Class for the evaluation and the EEG snapshots, runs without a dataset
+import os
+import tracemalloc
+import mne
+import numpy as np
+import pytest
+from facet.eeg_obj import EEG, CompactNoise
+from facet.frameworks.evaluation import EvaluationFramework
+
+
+class TestEvaluation:
+    def setup_method(self):
+        self.rng = np.random.default_rng(42)
+
+    def test_eeg_copy_on_write(self):
+        data = self.rng.standard_normal((3, 1000))
+        raw = mne.io.RawArray(data, mne.create_info(3, 1000, "eeg"), verbose=False)
+        eeg = EEG(mne_raw=raw, loaded_triggers=[10, 20])
+        eeg.estimated_noise = CompactNoise.from_dense(data)
+        data = data.copy()
+        snapshot = eeg.copy()
+        assert snapshot.mne_raw._data is not eeg.mne_raw._data
+        assert snapshot.mne_raw_orig._data is eeg.mne_raw_orig._data
+        assert snapshot.mne_raw_orig is not eeg.mne_raw_orig
+        assert eeg.mne_raw._data is raw._data
+        assert not eeg.mne_raw_orig._data.flags.writeable
+        snapshot.mne_raw._data[0] += 1
+        eeg.mne_raw._data[1] -= 1
+        snapshot.estimated_noise.blocks[0][0] = 0
+        snapshot.loaded_triggers.append(30)
+        assert np.array_equal(eeg.mne_raw._data[0], data[0])
+        assert np.array_equal(eeg.mne_raw._data[1], data[1] - 1)
+        assert np.array_equal(snapshot.mne_raw._data[1], data[1])
+        assert np.array_equal(snapshot.mne_raw._data[0], data[0] + 1)
+        assert np.array_equal(eeg.estimated_noise.toarray()[0], data[0])
+        assert eeg.loaded_triggers == [10, 20]
+
+    @pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="no memory files")
+    def test_eeg_copy_allocation(self):
+        data = self.rng.standard_normal((8, 100000))
+        raw = mne.io.RawArray(data, mne.create_info(8, 1000, "eeg"), verbose=False)
+        eeg = EEG(mne_raw=raw)
+        tracemalloc.start()
+        try:
+            snapshot = eeg.copy()
+            # writing a channel duplicates only this channel
+            snapshot.mne_raw._data[0] += 1
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < data.nbytes / 4
+        assert np.array_equal(eeg.mne_raw._data, data)
+        assert np.array_equal(snapshot.mne_raw._data[1:], data[1:])
+
+    def test_eeg_copy_on_write_memmap(self, tmp_path):
+        data = self.rng.standard_normal((3, 1000))
+        raw = mne.io.RawArray(data, mne.create_info(3, 1000, "eeg"), verbose=False)
+        eeg = EEG(mne_raw=raw, memmap_dir=str(tmp_path))
+        raw._data = eeg.store(data)
+        snapshot = eeg.copy()
+        assert isinstance(snapshot.mne_raw._data, np.memmap)
+        assert isinstance(eeg.mne_raw._data, np.memmap)
+        snapshot.mne_raw._data[0] += 1
+        eeg.mne_raw._data[1] -= 1
+        assert np.array_equal(eeg.mne_raw._data[0], data[0])
+        assert np.array_equal(eeg.mne_raw._data[1], data[1] - 1)
+        assert np.array_equal(snapshot.mne_raw._data[1], data[1])
+        assert np.array_equal(snapshot.mne_raw._data[0], data[0] + 1)
+
+    def test_evaluation_windows(self):
+        data = self.rng.standard_normal((3, 1000))
+        raw = mne.io.RawArray(data, mne.create_info(3, 100, "eeg"), verbose=False)
+        raw.info["bads"] = ["1"]
+        evaluation = EvaluationFramework(None, n_jobs=2)
+        evaluation._block_samples = 64
+        eeg = EEG(mne_raw=raw)
+        evaluation.add_to_evaluate(eeg, start_time=2.004, end_time=7.5)
+        evaluation.add_to_evaluate(eeg, start_time=1, end_time=3)
+        mnedict = evaluation._eeg_eval_dict_list[0]
+        channels = mnedict["channels"]
+        blocks = list(evaluation._blocks(raw._data, channels, mnedict["raw"]))
+        expected = raw.copy().crop(2.004, 7.5).pick(["0", "2"]).get_data()
+        assert np.array_equal(np.concatenate(blocks, axis=1), expected)
+        first, second = raw.copy().crop(tmax=2.004), raw.copy().crop(tmin=7.5)
+        first.append(second)
+        reference = first.pick(["0", "2"]).get_data()
+        blocks = list(evaluation._blocks(raw._data, channels, mnedict["ref"]))
+        assert np.array_equal(np.concatenate(blocks, axis=1), reference)
+        results = evaluation.evaluate(plot=False, measures=["SNR", "RMS", "RMS2"])
+        snr = np.abs(
+            np.var(reference, axis=1)
+            / (np.var(expected, axis=1) - np.var(reference, axis=1))
+        )
+        assert np.isclose(results[0]["Values"][0], np.mean(snr))
+        rms_orig, rms_corrected, rms_ref = (
+            np.sqrt(np.mean(x**2, axis=1)) for x in (data[:2], expected, reference)
+        )
+        assert np.isclose(results[1]["Values"][0], np.median(rms_orig / rms_corrected))
+        assert np.isclose(results[2]["Values"][0], np.median(rms_corrected / rms_ref))
+        assert np.allclose(
+            evaluation.evaluate_SNR(),
+            [evaluation.evaluate_SNR()[0], results[0]["Values"][1]],
+        )
+        # the entries refer to the data, the uncorrected data is shared read-only
+        assert all(
+            entry["data"] is raw._data for entry in evaluation._eeg_eval_dict_list
+        )
+        assert mnedict["orig"] is eeg.mne_raw_orig._data
+        assert not mnedict["orig"].flags.writeable and raw._data.flags.writeable
+        # snapshots are taken on request only
+        evaluation.add_to_evaluate(eeg, start_time=2.004, end_time=7.5, copy=True)
+        raw._data[:] = 0
+        assert np.allclose(evaluation.evaluate_SNR()[2], np.mean(snr))
+
+    def test_evaluation_moments_offset(self):
+        data = 1e4 + 1e-6 * self.rng.standard_normal((3, 1000))
+        raw = mne.io.RawArray(data, mne.create_info(3, 100, "eeg"), verbose=False)
+        evaluation = EvaluationFramework(None)
+        evaluation._block_samples = 64
+        evaluation.add_to_evaluate(EEG(mne_raw=raw), start_time=1, end_time=9)
+        moments = evaluation._moments(evaluation._eeg_eval_dict_list[0])
+        evaluated = raw.copy().crop(1, 9).get_data()
+        assert np.allclose(
+            evaluation._power(moments["raw"]), np.var(evaluated, axis=1), rtol=1e-6
+        )
+        assert np.allclose(
+            evaluation._rms(moments["orig"]), np.sqrt(np.mean(data**2, axis=1))
+        )
+
+    def test_evaluation_reads_orig_for_rms_only(self):
+        data = self.rng.standard_normal((3, 1000))
+        raw = mne.io.RawArray(data, mne.create_info(3, 100, "eeg"), verbose=False)
+        evaluation = EvaluationFramework(None)
+        evaluation.add_to_evaluate(EEG(mne_raw=raw), start_time=1, end_time=9)
+        expected = evaluation.evaluate(plot=False, measures=["SNR", "RMS2"])
+        # the uncorrected data is not read without the RMS of it to the corrected data
+        evaluation._eeg_eval_dict_list[0]["orig"] = None
+        results = evaluation.evaluate(plot=False, measures=["SNR", "RMS2"])
+        assert [result["Values"] for result in results] == [
+            result["Values"] for result in expected
+        ]
+        assert set(
+            evaluation._moments(evaluation._eeg_eval_dict_list[0], ("raw",))
+        ) == {"raw"}
+
+    def test_median_imaging_artifact(self):
+        data = self.rng.standard_normal((4, 5000))
+        info = mne.create_info(4, 500, ["eeg", "eeg", "eeg", "stim"])
+        raw = mne.io.RawArray(data, info, verbose=False)
+        triggers = np.sort(self.rng.choice(np.arange(0, 5000), 30, replace=False))
+        eeg = EEG(
+            mne_raw=raw,
+            loaded_triggers=list(triggers),
+            artifact_to_trigger_offset=-0.01,
+            artifact_duration=0.1,
+        )
+        epochs = mne.Epochs(
+            raw,
+            np.column_stack(
+                (triggers, np.zeros_like(triggers), np.ones_like(triggers))
+            ),
+            tmin=-0.01,
+            tmax=0.09,
+            picks=[0, 1, 2],
+            baseline=None,
+            preload=True,
+            verbose=False,
+        )
+        expected = np.median(np.mean(np.ptp(epochs.get_data(), axis=-1), axis=1))
+        evaluation = EvaluationFramework(None)
+        evaluation.add_to_evaluate(eeg, start_time=1, end_time=2)
+        assert np.allclose(
+            evaluation.calculate_median_imaging_artifact(chunked=False), [expected]
+        )
+        evaluation._batch_bytes = 1
+        assert np.allclose(evaluation.calculate_median_imaging_artifact(), [expected])
+        # a dataset without triggers keeps its place in the results
+        eeg.loaded_triggers = None
+        evaluation.add_to_evaluate(eeg, start_time=1, end_time=2)
+        evaluation._eeg_eval_dict_list.reverse()
+        assert np.allclose(
+            evaluation.calculate_median_imaging_artifact(),
+            [np.nan, expected],
+            equal_nan=True,
+        )
@@ -4,6 +4,7 @@ import pytest, os
 from facet.facet import facet
 from loguru import logger
 import random
+import numpy as np
 
 
 class TestAnalysisframework:
@@ -25,6 +26,21 @@ class TestAnalysisframework:
         assert self.f._eeg.mne_raw_orig is not None
         assert self.f._eeg.data_time_start == 0
 
+    def test_import_eeg_memmap(self, tmp_path):
+        f = facet()
+        eeg = f.import_eeg(
+            FILENAME_eeg,
+            artifact_to_trigger_offset=-0.005,
+            bads=["EMG", "ECG"],
+            memmap_dir=str(tmp_path),
+        )
+        assert isinstance(eeg.mne_raw._data, np.memmap)
+        assert isinstance(eeg.mne_raw_orig._data, np.memmap)
+        assert eeg.estimated_noise.memmap_dir == str(tmp_path)
+        assert np.array_equal(eeg.mne_raw._data, self.f._eeg.mne_raw_orig._data)
+        f.get_correction().upsample()
+        assert isinstance(eeg.mne_raw._data, np.memmap)
+
     def test_find_triggers(self):
         self.cf.filter(l_freq=1)
         self.cf.upsample()
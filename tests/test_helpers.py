@@ -0,0 +1,164 @@
+# Unit Test Class for the helper functions, runs without a dataset
+import numpy as np
+from scipy.signal import filtfilt, fftconvolve, firls
+from facet.helpers.utils import split_vector, epoch_view
+from facet.helpers.crosscorr import (
+    crosscorrelation,
+    crosscorrelation_batched,
+    CrossCorrelationWorkspace,
+)
+from facet.helpers.fdaf import fdaf_anc
+from facet.helpers import fastranc
+from facet.helpers.zerophase import fir_zero_phase
+from facet.helpers.moosmann import moving_average, _nearest_volumes
+from facet.eeg_obj import CompactNoise
+
+
+class TestHelpers:
+    def setup_method(self):
+        self.rng = np.random.default_rng(42)
+        self.vector = self.rng.standard_normal(1000)
+
+    def test_epoch_view_matches_split_vector(self):
+        markers = np.array([-5, 3, 50, 51, 400.7, 980])
+        epochs = epoch_view(self.vector, markers, 64)
+        for i, marker in enumerate(markers.astype(int)):
+            start, stop = max(marker, 0), min(marker + 64, 1000)
+            expected = np.zeros(64)
+            expected[start - marker : stop - marker] = self.vector[start:stop]
+            assert np.array_equal(epochs[i], expected)
+        assert np.array_equal(split_vector(self.vector, markers, 64), epochs)
+
+    def test_epoch_view_is_view_for_regular_markers(self):
+        epochs = epoch_view(self.vector, np.arange(0, 500, 50), 60)
+        assert np.shares_memory(epochs, self.vector)
+        assert not epochs.flags.writeable
+        epochs = epoch_view(self.vector, np.arange(0, 500, 50), 60, writeable=True)
+        epochs[1, 0] = 42
+        assert self.vector[50] == 42
+
+    def test_epoch_view_multichannel(self):
+        data = self.rng.standard_normal((3, 1000))
+        markers = [10, 200, 990]
+        epochs = epoch_view(data, markers, 30)
+        assert epochs.shape == (3, 3, 30)
+        for ch in range(3):
+            assert np.array_equal(epochs[ch], split_vector(data[ch], markers, 30))
+
+    def test_crosscorrelation_batched(self):
+        x = self.rng.standard_normal((5, 120))
+        y = self.rng.standard_normal((5, 100))
+        for mode in ["dot", "corr"]:
+            batched = crosscorrelation_batched(x, y, 30, mode=mode)
+            for i in range(5):
+                expected = crosscorrelation(x[i], y[i], 30, mode=mode)
+                assert np.allclose(batched[i], expected)
+                assert np.argmax(batched[i]) == np.argmax(expected)
+
+    def test_crosscorrelation_methods(self):
+        workspace = CrossCorrelationWorkspace()
+        template = self.rng.standard_normal(200)
+        for _ in range(3):
+            signal = self.rng.standard_normal(230)
+            for mode in ["dot", "corr"]:
+                direct = crosscorrelation(signal, template, 20, mode, method="direct")
+                fft = crosscorrelation(
+                    signal, template, 20, mode, method="fft", workspace=workspace
+                )
+                assert np.allclose(direct, fft)
+        # the buffers of the workspace are reused across calls
+        assert crosscorrelation(
+            signal, template, 20, "corr", method="fft", workspace=workspace
+        ) is crosscorrelation(
+            signal, template, 20, "corr", method="fft", workspace=workspace
+        )
+        expected = np.correlate(signal, np.pad(template, (0, 30)), mode="full")
+        assert np.allclose(
+            crosscorrelation(signal, template, 20, "dot"), expected[209:250]
+        )
+
+    def test_moving_average_band(self):
+        weighting_matrix = moving_average(50, 7).toarray()
+        rows, cols = np.indices((50, 50))
+        assert np.array_equal(weighting_matrix, np.abs(rows - cols) <= 3)
+
+    def test_nearest_volumes(self):
+        motion = np.zeros(200)
+        motion[[20, 75, 76, 150]] = self.rng.uniform(1, 2, 4)
+        slid_win = _nearest_volumes(motion, 25, block_bytes=8 * 200 * 7)
+        scaling = 25 / np.min(motion[motion > 0])
+        for j in range(200):
+            distance = np.where(
+                np.arange(200) < j, j - np.arange(200), np.arange(200) - j + 1
+            ).astype(float)
+            distance += scaling * np.cumsum(np.concatenate((-motion[:j], motion[j:])))
+            distance[motion > 0] = np.nan
+            expected = np.argsort(distance, kind="stable")[:25]
+            assert np.array_equal(np.sort(slid_win[j]), np.sort(expected))
+
+    def test_fdaf_anc_converges(self):
+        reference = self.rng.standard_normal(5000)
+        signal = np.convolve(reference, [0.5, -0.2, 0.1])[:5000]
+        out, filtered = fdaf_anc(reference, signal, 10, 0.05 / (10 * np.var(reference)))
+        assert np.all(out[:10] == 0) and np.all(filtered[:10] == 0)
+        assert np.allclose(filtered[2500:], signal[2500:])
+        assert np.allclose(out[2500:], 0)
+
+    def test_fir_zero_phase(self):
+        weights = firls(101, [0, 0.1, 0.2, 1], [0, 0, 1, 1])
+        data = self.rng.standard_normal((2, 1000))
+        expected = filtfilt(weights, 1, data, axis=-1, padtype="odd")
+        assert np.allclose(fir_zero_phase(data, weights), expected)
+        assert np.allclose(
+            fir_zero_phase(data, weights, 200, 700), expected[:, 200:700]
+        )
+        assert np.allclose(
+            fir_zero_phase(self.vector, weights, 30, passes=1),
+            fftconvolve(self.vector, weights, mode="same")[30:],
+        )
+
+    def test_single_precision(self):
+        reference = self.rng.standard_normal((2, 3000))
+        signal = reference + 0.1 * self.rng.standard_normal((2, 3000))
+        expected = fastranc.fastr_anc_multichannel(reference, signal, 8, 0.001)
+        single = fastranc.fastr_anc_multichannel(
+            reference.astype(np.float32), signal.astype(np.float32), 8, 0.001
+        )
+        assert single[0].dtype == np.float32
+        assert np.allclose(single[1], expected[1], atol=1e-4)
+        x, y = reference[:, :120], reference[:, 10:110]
+        corr = crosscorrelation_batched(x.astype(np.float32), y.astype(np.float32), 20)
+        assert np.allclose(corr, crosscorrelation_batched(x, y, 20), atol=1e-5)
+
+    def test_compact_noise(self):
+        noise = CompactNoise((4, 1000))
+        expected = np.zeros((4, 1000))
+        for start in [400, 420, 100, 900]:
+            positions = np.arange(start, start + 50)
+            values = self.rng.standard_normal(50)
+            noise.reserve([2, 1], start, start + 50)
+            noise.add(2, positions, values, overlapping=False)
+            expected[2, positions] += values
+        assert noise.channels == [2, 1] and noise.any()
+        assert np.array_equal(noise.toarray(), expected)
+        assert np.array_equal(noise.rows([3, 2], 300, 500), expected[[3, 2], 300:500])
+        assert noise.starts == [100, 400, 900]
+        assert [block.shape[1] for block in noise.blocks] == [50, 100, 50]
+        compact = CompactNoise.from_dense(expected)
+        assert compact.channels == [2] and compact.starts == [100, 400, 900]
+        assert compact.spans(40) == [(60, 190), (360, 510), (860, 990)]
+        assert np.array_equal(np.asarray(compact), expected)
+
+    def test_compact_noise_memmap(self, tmp_path):
+        expected = np.zeros((3, 1000))
+        expected[1, 100:150] = expected[2, 600:700] = 1
+        noise = CompactNoise.from_dense(expected, memmap_dir=str(tmp_path))
+        assert all(isinstance(block, np.memmap) for block in noise.blocks)
+        copied = noise.copy()
+        noise.blocks[0][0] += 1
+        copied.add_block([0], 800, np.ones((1, 10)))
+        noise.add_block([1], 800, np.ones((1, 10)))
+        assert np.array_equal(np.asarray(copied)[:, :800], expected[:, :800])
+        assert np.array_equal(np.asarray(noise)[1, 100:150], expected[1, 100:150] + 1)
+        assert np.array_equal(np.asarray(copied)[0, 800:810], np.ones(10))
+        assert not np.asarray(copied)[1, 800:].any()
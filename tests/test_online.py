@@ -0,0 +1,83 @@
+# Unit Test Class for the online correction, runs without a dataset
+import mne
+import numpy as np
+import pytest
+from facet.eeg_obj import EEG
+from facet.frameworks.online import OnlineCorrectionFramework
+from facet.helpers.utils import epoch_starts
+
+
+class TestOnlineCorrection:
+    def setup_method(self):
+        self.rng = np.random.default_rng(42)
+        artifact = 50 * np.sin(np.linspace(0, 20, 90))
+        self.artifact = artifact - np.mean(artifact)
+        self.triggers = np.arange(10, 9900, 100)
+
+    def stream(self, corrector, data, block_size):
+        blocks = []
+        for start in range(0, data.shape[1], block_size):
+            triggers = self.triggers[
+                (self.triggers >= start) & (self.triggers < start + block_size)
+            ]
+            blocks.append(
+                corrector.push(data[:, start : start + block_size], triggers - start)
+            )
+        blocks.append(corrector.flush())
+        return np.concatenate(blocks, axis=1)
+
+    @pytest.mark.parametrize("block_size", [1, 64, 5000])
+    def test_online_correction(self, block_size):
+        clean = self.rng.standard_normal((2, 10000))
+        data = clean.copy()
+        for trigger in self.triggers:
+            data[:, trigger - 5 : trigger + 85] += self.artifact
+        corrector = OnlineCorrectionFramework(2, 1000, -0.005, 0.085)
+        corrected = self.stream(corrector, data, block_size)
+        assert corrected.shape == data.shape
+        assert corrector.stats["artifacts"] == len(self.triggers)
+        assert corrector.stats["samples_out"] == data.shape[1]
+        assert corrector.max_latency <= 5 + 90 + block_size
+        assert np.std(corrected[:, 3000:] - clean[:, 3000:]) < 0.3
+
+    def test_from_eeg_corrects_eeg_channels_only(self):
+        data = self.rng.standard_normal((4, 10000))
+        data[3] = 0
+        data[3, self.triggers] = 1
+        clean = data.copy()
+        for trigger in self.triggers:
+            data[:3, trigger - 5 : trigger + 85] += self.artifact
+        info = mne.create_info(4, 1000, ["eeg", "eeg", "eeg", "stim"])
+        info["bads"] = ["1"]
+        raw = mne.io.RawArray(data, info, verbose=False)
+        eeg = EEG(
+            mne_raw=raw, artifact_to_trigger_offset=-0.005, artifact_duration=0.09
+        )
+        corrector = OnlineCorrectionFramework.from_eeg(eeg)
+        assert list(corrector.picks) == [0, 2]
+        corrected = self.stream(corrector, data, 64)
+        assert np.array_equal(corrected[[1, 3]], data[[1, 3]])
+        assert np.std(corrected[[0, 2], 3000:] - clean[[0, 2], 3000:]) < 0.3
+
+    def test_template_of_earlier_epochs(self):
+        data = np.zeros((1, 400))
+        # the window at 100 covers samples 95 to 185, one more than the artifact
+        data[:, 95:185] += self.artifact
+        data[:, 195:285] += 2 * self.artifact
+        self.triggers = np.array([100, 200])
+        corrector = OnlineCorrectionFramework(1, 1000, -0.005, 0.085)
+        corrected = self.stream(corrector, data, 400)
+        assert corrector._length == 91
+        # the first artifact has no earlier template, the second is corrected by the first
+        assert np.array_equal(corrected[:, 95:186], data[:, 95:186])
+        assert np.allclose(corrected[:, 195:285], self.artifact, atol=0.5)
+
+    def test_window_length_matches_epochs(self):
+        info = mne.create_info(2, 1000, ["eeg", "stim"])
+        raw = mne.io.RawArray(np.zeros((2, 1000)), info, verbose=False)
+        eeg = EEG(
+            mne_raw=raw, artifact_to_trigger_offset=-0.005, artifact_duration=0.09
+        )
+        events = np.array([[500, 0, 1]])
+        _, n_samples = epoch_starts(raw, events, eeg.get_tmin(), eeg.get_tmax())
+        assert OnlineCorrectionFramework.from_eeg(eeg)._length == n_samples